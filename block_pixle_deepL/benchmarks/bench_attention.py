@@ -0,0 +1,94 @@
+"""
+Time and peak memory of the TAE multi-head attention with the values repeated for every head (v.repeat, the former
+implementation) and shared by the heads (MultiHeadAttention.forward), by default at the size of the pse fusion TAE
+(d_in=256, 4 heads). Each case runs in its own process, the peak memory is the growth of its resident set size during
+forward+backward (read from /proc, Linux only).
+
+Usage (from the block_pixle_deepL folder):
+    python -m benchmarks.bench_attention --batch_size 2048
+"""
+
+import time
+import argparse
+import multiprocessing
+import torch
+
+from models.tae_fusion import MultiHeadAttention
+
+
+def repeated(self, q, k, v):
+    d_k, d_in, n_head = self.d_k, self.d_in, self.n_head
+    sz_b, seq_len, _ = q.size()
+
+    q = self.fc1_q(q).view(sz_b, seq_len, n_head, d_k)
+    q = q.mean(dim=1).squeeze()
+    q = self.fc2(q.view(sz_b, n_head * d_k)).view(sz_b, n_head, d_k)
+    q = q.permute(1, 0, 2).contiguous().view(n_head * sz_b, d_k)
+
+    k = self.fc1_k(k).view(sz_b, seq_len, n_head, d_k)
+    k = k.permute(2, 0, 1, 3).contiguous().view(-1, seq_len, d_k)
+
+    v = v.repeat(n_head, 1, 1)
+    output, attn = self.attention(q, k, v)
+    return output.view(n_head, sz_b, 1, d_in).squeeze(dim=2), attn
+
+
+def make(args):
+    torch.manual_seed(0)
+    model = MultiHeadAttention(n_head=args.n_head, d_k=32, d_in=args.d_in)
+    x = torch.randn(args.batch_size, args.seq_len, args.d_in, requires_grad=True)
+    return model, x
+
+
+def memory_kb(field):
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith(field):
+                return int(line.split()[1])
+
+
+def run(name, args, queue):
+    model, x = make(args)
+    forward = (lambda: repeated(model, x, x, x)) if name == 'repeat' else (lambda: model(x, x, x))
+    with open('/proc/self/clear_refs', 'w') as file:
+        file.write('5')  # resets the peak resident set size
+    base = memory_kb('VmRSS')
+    forward()[0].sum().backward()  # warm-up
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        forward()[0].sum().backward()
+        times.append(time.perf_counter() - start)
+    peak = memory_kb('VmHWM') - base
+    queue.put((1000 * min(times), peak / 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=1024, type=int)
+    parser.add_argument('--seq_len', default=27, type=int)
+    parser.add_argument('--d_in', default=256, type=int)
+    parser.add_argument('--n_head', default=4, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    args = parser.parse_args()
+
+    model, x = make(args)
+    torch.manual_seed(1)  # same attention dropout mask
+    out = model(x, x, x)[0]
+    torch.manual_seed(1)
+    ref = repeated(model, x, x, x)[0]
+    grad = torch.randn_like(out)
+    g, g_ref = torch.autograd.grad(out, x, grad)[0], torch.autograd.grad(ref, x, grad)[0]
+    print('identical: output {} | gradient {}'.format(torch.equal(out, ref), torch.equal(g, g_ref)))
+
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for name in ('repeat', 'shared'):
+        queue = ctx.Queue()
+        process = ctx.Process(target=run, args=(name, args, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+        print('{:<7} forward+backward {:>8.1f} ms | peak memory +{:>7.1f} MB'.format(name, *results[name]))
+    print('x{:.2f} time | {:.1f} MB less peak memory'.format(results['repeat'][0] / results['shared'][0],
+                                                             results['repeat'][1] - results['shared'][1]))
@@ -0,0 +1,56 @@
+"""
+Loader throughput of PixelSetData with the default per-sample processing against batch_collate mode, where
+sampling, normalisation and jitter are applied to whole batches by PixelSetData.collate_fn, on a split of small
+parcels (up to 120 pixels) and on a split of large ones (up to --large_pixels pixels).
+
+Usage (from the block_pixle_deepL folder):
+    python -m benchmarks.bench_collate --fusion_type pse
+"""
+
+import time
+import argparse
+import tempfile
+from torch.utils import data
+
+from benchmarks.synthetic import make_split, norm_stats
+from dataset_fusion import PixelSetData
+
+
+def samples_per_sec(loader, repeat):
+    start = time.perf_counter()
+    n = 0
+    for _ in range(repeat):
+        for batch in loader:
+            n += len(batch[2])
+    return n / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fusion_type', default='pse', type=str)
+    parser.add_argument('--npixel', default=40, type=int)
+    parser.add_argument('--n_parcels', default=1024, type=int)
+    parser.add_argument('--n_large_parcels', default=256, type=int)
+    parser.add_argument('--large_pixels', default=3000, type=int, help='Largest parcel size of the large-parcel split')
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--num_workers', default=0, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--jitter', action='store_true', help='Add the gaussian jitter (as in training)')
+    args = parser.parse_args()
+
+    norm_s1, norm_s2 = norm_stats()
+    for name, n_parcels, max_pixels in (('small parcels', args.n_parcels, 120),
+                                        ('large parcels', args.n_large_parcels, args.large_pixels)):
+        with tempfile.TemporaryDirectory() as root:
+            folder = make_split(root, n_parcels=n_parcels, max_pixels=max_pixels)
+            res = {}
+            for batch_collate in (False, True):
+                dt = PixelSetData(folder, labels='label_51class', npixel=args.npixel, norm_s1=norm_s1, norm_s2=norm_s2,
+                                  extra_feature='geomfeat', minimum_sampling=None, fusion_type=args.fusion_type,
+                                  jitter=(0.01, 0.05) if args.jitter else None, return_id=True,
+                                  batch_collate=batch_collate)
+                loader = data.DataLoader(dt, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True,
+                                         collate_fn=dt.collate_fn if batch_collate else None)
+                res[batch_collate] = samples_per_sec(loader, args.repeat)
+        print('{:<14} per sample {:>7.0f} samples/s | batch collate {:>7.0f} samples/s | x{:.1f}'.format(
+            name, res[False], res[True], res[True] / res[False]))
@@ -0,0 +1,56 @@
+"""
+Micro-benchmark of the convlstm fusion head: the original per-step loop (one conv on [x_t, h] and the five fc layers)
+against convlstm.forward, in training (forward+backward) and inference (eval, no_grad). --precompute forces the
+batched input-half convolution (the default on GPU only).
+
+Usage (from the block_pixle_deepL folder):
+    python -m benchmarks.bench_convlstm --precompute
+"""
+
+import argparse
+import torch
+
+from benchmarks.timing import best_ms
+from models.convlstm_fusion import convlstm
+
+
+def reference(model, x):
+    x = x.unsqueeze(2).permute(0, 2, 1, 3)
+    x = model.inconv(torch.nn.functional.pad(x, (1, 1), 'constant', 0))
+    b, c, t, h = x.shape
+    hidden = torch.zeros((b, c, h), device=x.device)
+    state = torch.zeros((b, c, h), device=x.device)
+    for iter in range(t):
+        hidden, state = model.cell.forward(x[:, :, iter, :], (hidden, state))
+    x = model.flatten(state)
+    for fc in (model.fc1, model.fc2, model.fc3, model.fc4, model.fc5):
+        x = fc(x)
+    return x
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--seq_len', default=27, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--precompute', action='store_true')
+    parser.add_argument('--device', default='cpu', type=str)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = convlstm().to(args.device)
+    model.precompute_input = True if args.precompute else None
+    x = torch.randn(args.batch_size, args.seq_len, 128, device=args.device)
+
+    print('max abs difference: train {:.2e}'.format((reference(model, x) - model(x)).abs().max().item()))
+    train_ref = best_ms(lambda: reference(model, x).sum().backward(), args.repeat)[0]
+    train_new = best_ms(lambda: model(x).sum().backward(), args.repeat)[0]
+
+    model.eval()
+    with torch.no_grad():
+        print('max abs difference: eval {:.2e}'.format((reference(model, x) - model(x)).abs().max().item()))
+        eval_ref = best_ms(reference, args.repeat, model, x)[0]
+        eval_new = best_ms(model, args.repeat, x)[0]
+
+    for name, ref, new in (('forward+backward', train_ref, train_new), ('inference', eval_ref, eval_new)):
+        print('{:<18} per-step loop {:>8.1f} ms | convlstm {:>8.1f} ms | x{:.2f}'.format(name, ref, new, ref / new))
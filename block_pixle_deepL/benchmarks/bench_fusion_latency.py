@@ -0,0 +1,64 @@
+"""
+Per-batch latency of PseTae for every fusion type, with the S1 and S2 streams run one after the other (default) and
+concurrently (parallel_sensors=True), in training (forward+backward) and inference (eval, no_grad). Concurrency only
+pays off with several CPU cores (or a GPU).
+
+Usage (from the block_pixle_deepL folder):
+    python -m benchmarks.bench_fusion_latency --fusion_types tsa softmax_avg
+"""
+
+import argparse
+import tempfile
+import torch
+from torch.utils import data
+
+from benchmarks.synthetic import make_split, norm_stats
+from benchmarks.timing import ms_per_batch
+from dataset_fusion import PixelSetData
+from models.stclassifier_fusion import PseTae
+
+
+def load_batches(root, fusion_type, args):
+    dt = PixelSetData(make_split(root, n_parcels=args.batch_size * args.n_batches), labels='label_51class',
+                      npixel=args.npixel, norm_s1=norm_s1, norm_s2=norm_s2, extra_feature='geomfeat',
+                      minimum_sampling=None, fusion_type='early' if fusion_type == 'convlstm' else fusion_type,
+                      return_id=True, jitter=None)
+    return [(x, x2, dates) for x, x2, y, dates, ids in data.DataLoader(dt, batch_size=args.batch_size)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fusion_types', nargs='+',
+                        default=['early', 'pse', 'tsa', 'softmax_norm', 'softmax_avg', 'convlstm'])
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--npixel', default=64, type=int)
+    parser.add_argument('--n_batches', default=4, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+
+    norm_s1, norm_s2 = norm_stats()
+    print('{} threads'.format(torch.get_num_threads()))
+    for fusion_type in args.fusion_types:
+        torch.manual_seed(0)
+        with tempfile.TemporaryDirectory() as root:
+            batches = load_batches(root, fusion_type, args)
+
+        mlp4 = [256 if fusion_type in ('pse', 'tsa') else 128, 64, 32, 21]
+        model = PseTae(input_dim_s1=4, input_dim_s2=17, mlp1=[17, 32, 64], mlp2=[135, 128], with_extra=True,
+                       extra_size=7, len_max_seq=30, fusion_type=fusion_type, mlp4=mlp4, active_only=True)
+
+        def train_step(x, x2, dates):
+            model(x, x2, dates).sum().backward()
+
+        def eval_step(x, x2, dates):
+            with torch.no_grad():
+                model(x, x2, dates)
+
+        for mode, step in (('train', train_step), ('eval', eval_step)):
+            model.train(mode == 'train')
+            model.parallel_sensors = False
+            sequential = ms_per_batch(step, batches, args.repeat)
+            model.parallel_sensors = True
+            parallel = ms_per_batch(step, batches, args.repeat)
+            print('{:<13} {:<5} sequential {:>8.1f} ms/batch | parallel {:>8.1f} ms/batch | x{:.2f}'.format(
+                fusion_type, mode, sequential, parallel, sequential / parallel))
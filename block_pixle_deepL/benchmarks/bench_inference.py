@@ -0,0 +1,59 @@
+"""
+Latency of PseTae inference on CPU: eager eval model, BatchNorm-folded eager model and frozen TorchScript model
+(models/inference.py), on batches of a synthetic split.
+
+Usage (from the block_pixle_deepL folder):
+    python -m benchmarks.bench_inference --fusion_type pse
+"""
+
+import argparse
+import tempfile
+import torch
+from torch.utils import data
+
+from benchmarks.synthetic import make_split, norm_stats
+from benchmarks.timing import ms_per_batch
+from dataset_fusion import PixelSetData
+from models.stclassifier_fusion import PseTae
+from models.inference import optimize_for_inference
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fusion_type', default='pse', type=str)
+    parser.add_argument('--batch_size', default=128, type=int)
+    parser.add_argument('--npixel', default=64, type=int)
+    parser.add_argument('--n_batches', default=4, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    norm_s1, norm_s2 = norm_stats()
+    with tempfile.TemporaryDirectory() as root:
+        dt = PixelSetData(make_split(root, n_parcels=args.batch_size * args.n_batches), labels='label_51class',
+                          npixel=args.npixel, norm_s1=norm_s1, norm_s2=norm_s2, extra_feature='geomfeat',
+                          minimum_sampling=None, fusion_type='early' if args.fusion_type == 'convlstm' else args.fusion_type,
+                          return_id=True, jitter=None)
+        batches = [(x, x2, dates) for x, x2, y, dates, ids in data.DataLoader(dt, batch_size=args.batch_size)]
+
+    mlp4 = [256 if args.fusion_type in ('pse', 'tsa') else 128, 64, 32, 21]
+    model = PseTae(input_dim_s1=4, input_dim_s2=17, mlp1=[17, 32, 64], mlp2=[135, 128], with_extra=True,
+                   extra_size=7, len_max_seq=30, fusion_type=args.fusion_type, mlp4=mlp4)
+    with torch.no_grad():  # non-trivial BatchNorm statistics
+        for x, x2, dates in batches:
+            model(x, x2, dates)
+    model.eval()
+
+    folded = optimize_for_inference(model, script=False)
+    frozen = optimize_for_inference(model, batches[0])
+    with torch.no_grad():
+        x, x2, dates = batches[-1]
+        ref = model(x, x2, dates)
+        print('max abs difference: folded {:.2e} | frozen {:.2e}'.format(
+            (folded(x, x2, dates) - ref).abs().max().item(), (frozen(x, x2, dates) - ref).abs().max().item()))
+
+    with torch.no_grad():
+        eager = ms_per_batch(model, batches, args.repeat)
+        for name, m in (('folded', folded), ('frozen', frozen)):
+            t = ms_per_batch(m, batches, args.repeat)
+            print('{:<7} eager {:>7.2f} ms/batch | {:>7.2f} ms/batch | x{:.2f}'.format(name, eager, t, eager / t))
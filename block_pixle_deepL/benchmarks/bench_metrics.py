@@ -0,0 +1,118 @@
+"""
+Micro-benchmark of the evaluation metrics of learning/metrics.py: mIou and confusion_matrix_analysis (one bincount
+confusion matrix, diagonal/row/column sums) against the original per-class loops, on random labels of the 51 classes
+of label_51class. The y_true/y_pred are python lists, as built by the evaluation loops of run_transferlearning and
+run_inference, and the outputs of both implementations are checked to be identical.
+
+Usage (from the block_pixle_deepL folder):
+    python -m benchmarks.bench_metrics --n_samples 1000000
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+
+from benchmarks.timing import best_ms
+from learning.metrics import mIou, confusion_matrix_analysis
+from sklearn.metrics import confusion_matrix
+
+
+def mIou_reference(y_true, y_pred, n_classes):
+    iou = 0
+    n_observed = n_classes
+    for i in range(n_classes):
+        y_t = (np.array(y_true) == i).astype(int)
+        y_p = (np.array(y_pred) == i).astype(int)
+
+        inter = np.sum(y_t * y_p)
+        union = np.sum((y_t + y_p > 0).astype(int))
+
+        if union == 0:
+            n_observed -= 1
+        else:
+            iou += inter / union
+
+    return iou / n_observed
+
+
+def confusion_matrix_analysis_reference(mat):
+    TP = 0
+    FP = 0
+    FN = 0
+    pre = 0
+
+    per_class = {}
+
+    for j in range(mat.shape[0]):
+        d = {}
+        tp = np.sum(mat[j, j])
+        fp = np.sum(mat[:, j]) - tp
+        fn = np.sum(mat[j, :]) - tp
+        probR = (np.sum(mat[j, :]))/(np.sum(mat))
+        probP = (np.sum(mat[:, j]))/(np.sum(mat))
+        chance = probR * probP
+
+        d['IoU'] = tp / (tp + fp + fn)
+        d['Precision'] = tp / (tp + fp)
+        d['Recall'] = tp / (tp + fn)
+        d['F1-score'] = 2 * tp / (2 * tp + fp + fn)
+
+        per_class[str(j)] = d
+
+        TP += tp
+        FP += fp
+        FN += fn
+        pre += chance
+
+    pra = np.sum(np.diag(mat)) / np.sum(mat)
+
+    overall = {}
+    overall['micro_IoU'] = TP / (TP + FP + FN)
+    overall['micro_Precision'] = TP / (TP + FP)
+    overall['micro_Recall'] = TP / (TP + FN)
+    overall['micro_F1-score'] = 2 * TP / (2 * TP + FP + FN)
+    overall['micro_Kappa'] = (pra-pre)/(1-pre)
+
+    macro = pd.DataFrame(per_class).transpose().mean()
+    overall['MACRO_IoU'] = macro.loc['IoU']
+    overall['MACRO_Precision'] = macro.loc['Precision']
+    overall['MACRO_Recall'] = macro.loc['Recall']
+    overall['MACRO_F1-score'] = macro.loc['F1-score']
+
+    overall['Accuracy'] = np.sum(np.diag(mat)) / np.sum(mat)
+
+    return per_class, overall
+
+
+def identical(a, b):
+    if isinstance(a, dict):
+        return list(a) == list(b) and all(identical(a[k], b[k]) for k in a)
+    if isinstance(a, tuple):
+        return len(a) == len(b) and all(identical(u, v) for u, v in zip(a, b))
+    return type(a) == type(b) and (a == b or (np.isnan(a) and np.isnan(b)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', default=1000000, type=int)
+    parser.add_argument('--num_classes', default=51, type=int)
+    parser.add_argument('--accuracy', default=0.7, type=float, help='Fraction of correct random predictions')
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+
+    rs = np.random.RandomState(0)
+    # long-tailed class frequencies, with a few classes never observed
+    freq = rs.pareto(1., args.num_classes) * (rs.rand(args.num_classes) > 0.1)
+    y_true = rs.choice(args.num_classes, args.n_samples, p=freq / freq.sum())
+    y_pred = np.where(rs.rand(args.n_samples) < args.accuracy, y_true, rs.choice(args.num_classes, args.n_samples))
+    y_true, y_pred = y_true.tolist(), y_pred.tolist()
+    mat = confusion_matrix(y_true, y_pred, labels=list(range(args.num_classes)))
+
+    print('{} samples x {} classes'.format(args.n_samples, args.num_classes))
+    for name, reference, vectorized, inputs in (
+            ('mIou', mIou_reference, mIou, (y_true, y_pred, args.num_classes)),
+            ('confusion_matrix_analysis', confusion_matrix_analysis_reference, confusion_matrix_analysis, (mat,))):
+        ref_ms, ref_out = best_ms(reference, args.repeat, *inputs)
+        new_ms, new_out = best_ms(vectorized, args.repeat, *inputs)
+        print('{:<26} loop {:9.2f} ms | vectorized {:8.2f} ms | x{:6.1f} | identical {}'.format(
+            name, ref_ms, new_ms, ref_ms / new_ms, identical(ref_out, new_out)))
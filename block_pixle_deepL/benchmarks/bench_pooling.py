@@ -0,0 +1,41 @@
+"""
+Micro-benchmark of the mean_std pooling of PixelSetEncoder on CPU: the fused masked_mean_std against the
+masked_mean/masked_std pair, forward and forward+backward on a Batch_size*Sequence_length x 64 x npixel tensor.
+
+Usage (from the block_pixle_deepL folder):
+    python -m benchmarks.bench_pooling
+"""
+
+import argparse
+import torch
+
+from benchmarks.timing import ms_per_call
+from models.pse_fusion import masked_mean, masked_std, masked_mean_std
+
+
+def reference(x, mask):
+    return torch.cat([masked_mean(x, mask), masked_std(x, mask)], dim=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--seq_len', default=27, type=int)
+    parser.add_argument('--channels', default=64, type=int)
+    parser.add_argument('--npixel', default=64, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    n = args.batch_size * args.seq_len
+    x = torch.relu(torch.randn(n, args.channels, args.npixel)).requires_grad_()
+    mask = (torch.rand(n, args.npixel) > 0.3).float()
+    mask[:, 0] = 1
+
+    with torch.no_grad():
+        print('max abs difference: {:.2e}'.format((reference(x, mask) - masked_mean_std(x, mask)).abs().max().item()))
+    for backward in (False, True):
+        ref = ms_per_call(reference, (x, mask), backward, args.repeat)
+        fused = ms_per_call(masked_mean_std, (x, mask), backward, args.repeat)
+        print('{:<18} mean+std {:>7.2f} ms | fused {:>7.2f} ms | x{:.1f}'.format(
+            'forward+backward' if backward else 'forward', ref, fused, ref / fused))
@@ -0,0 +1,46 @@
+"""
+Micro-benchmark of the PixelSetEncoder layouts on CPU: the default MLP1 (permute to channel last and back at every
+layer) against channels_last=True (flat pixels x channels tensor), with the same weights, forward and
+forward+backward in train mode.
+
+Usage (from the block_pixle_deepL folder):
+    python -m benchmarks.bench_pse_layout
+"""
+
+import argparse
+import torch
+
+from benchmarks.timing import ms_per_call
+from models.pse_fusion import PixelSetEncoder
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--seq_len', default=27, type=int)
+    parser.add_argument('--input_dim', default=17, type=int)
+    parser.add_argument('--npixel', default=64, type=int)
+    parser.add_argument('--pooling', default='mean_std', type=str)
+    parser.add_argument('--repeat', default=20, type=int)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    mlp1 = [args.input_dim, 32, 64]
+    mlp2 = [64 * len(args.pooling.split('_')), 128]
+    default = PixelSetEncoder(args.input_dim, mlp1=mlp1, pooling=args.pooling, mlp2=mlp2, with_extra=False)
+    flat = PixelSetEncoder(args.input_dim, mlp1=mlp1, pooling=args.pooling, mlp2=mlp2, with_extra=False,
+                           channels_last=True)
+    flat.load_state_dict(default.state_dict())
+
+    x = torch.randn(args.batch_size, args.seq_len, args.input_dim, args.npixel)
+    mask = (torch.rand(args.batch_size, args.seq_len, args.npixel) > 0.3).float()
+    mask[..., 0] = 1
+    input = (x, mask)
+
+    with torch.no_grad():
+        print('max abs difference: {:.2e}'.format((default(input) - flat(input)).abs().max().item()))
+    for backward in (False, True):
+        ref = ms_per_call(default, (input,), backward, args.repeat)
+        last = ms_per_call(flat, (input,), backward, args.repeat)
+        print('{:<18} default {:>7.2f} ms | channels_last {:>7.2f} ms | x{:.1f}'.format(
+            'forward+backward' if backward else 'forward', ref, last, ref / last))
@@ -0,0 +1,85 @@
+"""
+Micro-benchmark of the pixel sampling/padding step of PixelSetData.__getitem__:
+sample_pixels (vectorized, reused buffers) against sample_pixels_reference (original implementation, below).
+
+Usage (from the block_pixle_deepL folder):
+    python -m benchmarks.bench_sampling
+"""
+
+import time
+import functools
+import argparse
+import tempfile
+import numpy as np
+
+from benchmarks.synthetic import make_split
+from dataset_fusion import PixelSetData
+
+
+def sample_pixels_reference(npixel, x0, x00):
+    """ Original per-sample sampling/padding code of PixelSetData.__getitem__. """
+    if x0.shape[-1] > npixel:
+        idx = np.random.choice(list(range(x0.shape[-1])), size=npixel, replace=False)
+        x = x0[:, :, idx]
+        x2 = x00[:, :, idx]
+        mask1, mask2 = np.ones(npixel), np.ones(npixel)
+
+    elif x0.shape[-1] < npixel:
+
+        if x0.shape[-1] == 0:
+            x = np.zeros((*x0.shape[:2], npixel))
+            x2 = np.zeros((*x00.shape[:2], npixel))
+            mask1, mask2 = np.zeros(npixel), np.zeros(npixel)
+            mask1[0], mask2[0] = 1, 1
+        else:
+            x = np.zeros((*x0.shape[:2], npixel))
+            x2 = np.zeros((*x00.shape[:2], npixel))
+
+            x[:, :, :x0.shape[-1]] = x0
+            x2[:, :, :x00.shape[-1]] = x00
+
+            x[:, :, x0.shape[-1]:] = np.stack([x[:, :, 0] for _ in range(x0.shape[-1], x.shape[-1])], axis=-1)
+            x2[:, :, x00.shape[-1]:] = np.stack([x2[:, :, 0] for _ in range(x00.shape[-1], x2.shape[-1])], axis=-1)
+            mask1 = np.array(
+                [1 for _ in range(x0.shape[-1])] + [0 for _ in range(x0.shape[-1], npixel)])
+            mask2 = np.array(
+                [1 for _ in range(x00.shape[-1])] + [0 for _ in range(x00.shape[-1], npixel)])
+    else:
+        x = x0
+        x2 = x00
+        mask1, mask2 = np.ones(npixel), np.ones(npixel)
+
+    return x, x2, mask1, mask2
+
+
+def samples_per_sec(fn, parcels, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for x0, x00 in parcels:
+            fn(x0, x00)
+    return repeat * len(parcels) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--npixel', default=40, type=int)
+    parser.add_argument('--n_parcels', default=256, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        dt = PixelSetData(make_split(root, n_parcels=8), labels='label_51class', npixel=args.npixel,
+                          minimum_sampling=None, jitter=None)
+
+    rs = np.random.RandomState(0)
+    for name, sizes in (('few pixels (N < npixel)', (1, args.npixel)),
+                        ('many pixels (N > npixel)', (args.npixel + 1, 10 * args.npixel)),
+                        ('mixed', (0, 10 * args.npixel))):
+        parcels = []
+        for _ in range(args.n_parcels):
+            n = rs.randint(*sizes)
+            parcels.append((rs.rand(30, 4, n).astype(np.float32), rs.rand(27, 17, n).astype(np.float32)))
+        ref = samples_per_sec(functools.partial(sample_pixels_reference, args.npixel), parcels, args.repeat)
+        vec = samples_per_sec(dt.sample_pixels, parcels, args.repeat)
+        print('{:<26} reference {:>9.0f} samples/s | vectorized {:>9.0f} samples/s | x{:.1f}'.format(
+            name, ref, vec, vec / ref))
@@ -0,0 +1,87 @@
+"""
+Checks bfloat16 autocast training (run_main --precision bf16) against fp32: the same model is trained from the same
+initialization and on the same batches in both precisions, on a small fixed synthetic split with learnable labels, and
+their best validation mIoU over the epochs (the checkpoint run_main keeps) must stay within --tolerance. Exits with
+status 1 otherwise. The epoch times are reported as well.
+
+Usage (from the block_pixle_deepL folder):
+    python -m benchmarks.check_bf16 --fusion_type pse
+"""
+
+import sys
+import copy
+import time
+import argparse
+import tempfile
+import torch
+from torch.utils import data
+
+from benchmarks.synthetic import make_split, norm_stats
+from dataset_fusion import PixelSetData
+from models.stclassifier_fusion import PseTae
+from learning.focal_loss import FocalLoss
+from learning.weight_init import weight_init
+from learning.precision import keep_norms_fp32
+from run_main import train_epoch, val_evaluation
+
+
+def train(model, precision, train_set, val_set, args):
+    run_args = {'precision': precision, 'display_step': 10 ** 9, 'num_classes': args.num_classes}
+    if precision == 'bf16':
+        keep_norms_fp32(model)
+    optimizer = torch.optim.NAdam(model.parameters())
+    criterion = FocalLoss(1)
+    torch.manual_seed(1)  # same batches and dropout masks in both precisions
+    train_loader = data.DataLoader(train_set, batch_size=args.batch_size, shuffle=True)
+    val_loader = data.DataLoader(val_set, batch_size=args.batch_size)
+
+    best, train_s = None, 0
+    for epoch in range(args.epochs):
+        model.train()
+        start = time.perf_counter()
+        train_epoch(model, optimizer, criterion, train_loader, 'cpu', run_args)
+        train_s += time.perf_counter() - start
+        model.eval()
+        metrics = val_evaluation(model, criterion, val_loader, 'cpu', run_args)
+        if best is None or metrics['val_IoU'] >= best['val_IoU']:
+            best = metrics
+    return best, train_s / args.epochs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fusion_type', default='pse', type=str)
+    parser.add_argument('--n_parcels', default=1024, type=int)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--epochs', default=6, type=int)
+    parser.add_argument('--num_classes', default=8, type=int)
+    parser.add_argument('--signal', default=1., type=float, help='Class signal of the synthetic split (see make_split)')
+    parser.add_argument('--tolerance', default=0.03, type=float, help='Largest allowed difference of validation mIoU')
+    args = parser.parse_args()
+
+    norm_s1, norm_s2 = norm_stats()
+    with tempfile.TemporaryDirectory() as root:
+        kwargs = dict(labels='label_51class', npixel=32, norm_s1=norm_s1, norm_s2=norm_s2, extra_feature='geomfeat',
+                      minimum_sampling=None, fusion_type='early' if args.fusion_type == 'convlstm' else args.fusion_type,
+                      return_id=True, jitter=None)
+        train_set = PixelSetData(make_split(root + '/train', n_parcels=args.n_parcels, n_classes=args.num_classes,
+                                            signal=args.signal, seed=0), **kwargs)
+        val_set = PixelSetData(make_split(root + '/val', n_parcels=args.n_parcels, n_classes=args.num_classes,
+                                          signal=args.signal, seed=1), **kwargs)
+
+        torch.manual_seed(0)
+        mlp4 = [256 if args.fusion_type in ('pse', 'tsa') else 128, 64, 32, args.num_classes]
+        model = PseTae(input_dim_s1=4, input_dim_s2=17, mlp1=[17, 32, 64], mlp2=[135, 128], with_extra=True,
+                       extra_size=7, len_max_seq=30, fusion_type=args.fusion_type, mlp4=mlp4, active_only=True)
+        model.apply(weight_init)
+
+        results = {}
+        for precision in ('fp32', 'bf16'):
+            metrics, epoch_s = train(copy.deepcopy(model), precision, train_set, val_set, args)
+            results[precision] = metrics['val_IoU']
+            print('{}: best val mIoU {:.4f} | val accuracy {:.2f} | {:.1f} s/epoch'.format(
+                precision, metrics['val_IoU'], metrics['val_accuracy'], epoch_s))
+
+    difference = abs(results['bf16'] - results['fp32'])
+    print('mIoU difference {:.4f} (tolerance {})'.format(difference, args.tolerance))
+    sys.exit(int(difference > args.tolerance))
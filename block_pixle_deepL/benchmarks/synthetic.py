@@ -0,0 +1,53 @@
+"""
+Synthetic split folders for the benchmarks, laid out like the real data (see README):
+    <root>/s1_data/{DATA,META} and <root>/s2_data/{DATA,META}
+"""
+
+import os
+import json
+import datetime as dt
+import numpy as np
+
+
+def make_split(root, n_parcels=512, t_s1=30, t_s2=27, c_s1=4, c_s2=17, max_pixels=120, n_classes=21,
+               label_class='label_51class', seed=0, signal=0.):
+    """
+    Writes a random split to root and returns the path of its s1_data folder.
+    Parcel sizes are drawn uniformly in [0, max_pixels] so that the sampling, padding and empty-parcel branches
+    of PixelSetData are all exercised. With signal > 0 the pixel values are shifted by signal * label / n_classes, so
+    that the labels can be learnt.
+    """
+    rs = np.random.RandomState(seed)
+    start = dt.date(2021, 1, 1)
+    dates_s1 = sorted(rs.choice(365, t_s1, replace=False))
+    dates_s2 = sorted(rs.choice(365, t_s2, replace=False))
+
+    for sensor, t, c, dates in (('s1_data', t_s1, c_s1, dates_s1), ('s2_data', t_s2, c_s2, dates_s2)):
+        os.makedirs(os.path.join(root, sensor, 'DATA'), exist_ok=True)
+        os.makedirs(os.path.join(root, sensor, 'META'), exist_ok=True)
+        with open(os.path.join(root, sensor, 'META', 'dates.json'), 'w') as file:
+            json.dump({str(i): int((start + dt.timedelta(days=int(d))).strftime('%Y%m%d')) for i, d in enumerate(dates)},
+                      file)
+
+    labels, geomfeat = {}, {}
+    for pid in range(n_parcels):
+        n = rs.randint(0, max_pixels + 1)
+        s1, s2 = rs.rand(t_s1, c_s1, n), rs.rand(t_s2, c_s2, n)
+        labels[str(pid)] = int(rs.randint(n_classes))
+        shift = signal * labels[str(pid)] / n_classes
+        np.save(os.path.join(root, 's1_data', 'DATA', '{}.npy'.format(pid)), (s1 + shift).astype(np.float32))
+        np.save(os.path.join(root, 's2_data', 'DATA', '{}.npy'.format(pid)), (s2 + shift).astype(np.float32))
+        geomfeat[str(pid)] = list(map(float, rs.rand(7)))
+
+    for sensor in ('s1_data', 's2_data'):
+        with open(os.path.join(root, sensor, 'META', 'labels.json'), 'w') as file:
+            json.dump({label_class: labels}, file)
+        with open(os.path.join(root, sensor, 'META', 'geomfeat.json'), 'w') as file:
+            json.dump(geomfeat, file)
+
+    return os.path.join(root, 's1_data')
+
+
+def norm_stats(c_s1=4, c_s2=17):
+    """ Channel-wise (mean, std) tuples in the format of the S1/S2-meanstd.pkl files. """
+    return (np.full(c_s1, 0.5), np.full(c_s1, 0.3)), (np.full(c_s2, 0.5), np.full(c_s2, 0.3))
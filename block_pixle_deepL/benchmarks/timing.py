@@ -0,0 +1,53 @@
+"""
+Timing helpers shared by the benchmarks.
+"""
+
+import time
+import torch
+
+
+def run(fn, inputs, backward):
+    """ One call of fn(*inputs): forward+backward of the sum of its output (gradients reset first), or no_grad forward. """
+    if backward:
+        if isinstance(fn, torch.nn.Module):
+            fn.zero_grad()
+        for x in inputs:
+            if isinstance(x, torch.Tensor):
+                x.grad = None
+        fn(*inputs).sum().backward()
+    else:
+        with torch.no_grad():
+            fn(*inputs)
+
+
+def ms_per_call(fn, inputs, backward, repeat, warmup=3):
+    """ Mean time (ms) of run(fn, inputs, backward) over repeat calls, after warmup calls. """
+    for _ in range(warmup):
+        run(fn, inputs, backward)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run(fn, inputs, backward)
+    return 1000 * (time.perf_counter() - start) / repeat
+
+
+def best_ms(fn, repeat, *args):
+    """ Best time (ms) of fn(*args) over repeat calls, and the output of the last call. """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(*args)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return 1000 * min(times), out
+
+
+def ms_per_batch(fn, batches, repeat):
+    """ Mean time (ms) of fn(x, x2, dates) per batch over repeat passes on the batches, after two warm-up batches. """
+    for x, x2, dates in batches[:2]:
+        fn(x, x2, dates)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for x, x2, dates in batches:
+            fn(x, x2, dates)
+    return 1000 * (time.perf_counter() - start) / (repeat * len(batches))
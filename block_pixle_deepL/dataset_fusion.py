@@ -4,7 +4,6 @@ from torch.utils import data
 import pickle as pkl
 import copy
 
-import pandas as pd
 import numpy as np
 import datetime as dt
 from datetime import datetime
@@ -12,10 +11,14 @@ from datetime import datetime
 import os
 import json  
 import random
+import zipfile
+
+from parcel_store import PackedParcelStore, ParcelArena
 
 class PixelSetData(data.Dataset):
     def __init__(self, folder, labels, npixel, sub_classes=None, norm_s1=None, norm_s2=None,
-                 extra_feature=None, jitter=(0.01, 0.05), minimum_sampling=27, interpolate_method ='nn', return_id=False, fusion_type=None):
+                 extra_feature=None, jitter=(0.01, 0.05), minimum_sampling=27, interpolate_method ='nn', return_id=False, fusion_type=None,
+                 packed=False, batch_collate=False):
         """
         Args:
             folder (str): path to the main folder of the dataset, formatted as indicated in the readme
@@ -30,6 +33,11 @@ class PixelSetData(data.Dataset):
             extra_feature (str): name of the additional static feature file to use
             jitter (tuple): if provided (sigma, clip) values for the addition random gaussian noise
             return_id (bool): if True, the id of the yielded item is also returned (useful for inference)
+            packed (bool): if True, parcels are read from the packed store of the folder (see parcel_store.py)
+                instead of one npy file per parcel
+            batch_collate (bool): if True, items are raw parcel arrays and the pixel sampling, normalisation, jitter
+                and S1/S2 date matching are done on whole batches by collate_fn, which must then be passed to the
+                DataLoader
         """
         super(PixelSetData, self).__init__()
 
@@ -47,77 +55,68 @@ class PixelSetData(data.Dataset):
         self.minimum_sampling = minimum_sampling        
         self.fusion_type = fusion_type
         self.interpolate_method = interpolate_method
+        self.packed = packed
+        self.batch_collate = batch_collate
+
 
+        # get parcel ids, labels, dates and extra features from the cached index of the folder
+        self.store_s1, self.store_s2 = None, None
+        if self.packed:
+            self.store_s1 = PackedParcelStore(folder)
+            self.store_s2 = PackedParcelStore(folder.replace('s1_data', 's2_data'))
+        index = load_index(folder, labels, extra_feature, pid=self.store_s1.pid if self.packed else None)
 
-        # get parcel ids
-        l = [f for f in os.listdir(self.data_folder) if f.endswith('.npy')]
-        self.pid = [int(f.split('.')[0]) for f in l]
-        self.pid = list(np.sort(self.pid))
+        self.pid = list(index['pid'])
         self.pid_shape = self.pid.copy()
         self.pid = list(map(str, self.pid))
         self.len = len(self.pid)        
 
         # get Labels
+        self.target = list(index['target'])
         if sub_classes is not None:
-            sub_indices = []
-            num_classes = len(sub_classes)
             convert = dict((c, i) for i, c in enumerate(sub_classes))
+            sub_indices = [i for i, t in enumerate(self.target) if t in sub_classes]
 
-        with open(os.path.join(folder, 'META', 'labels.json'), 'r') as file:
-            d = json.loads(file.read())
-            self.target = []
-            for i, p in enumerate(self.pid):
-                t = d[labels][p]
-
-                self.target.append(t)
-                if sub_classes is not None:
-                    if t in sub_classes:
-                        sub_indices.append(i)
-                        self.target[-1] = convert[self.target[-1]]
-                        
-        if sub_classes is not None:
             self.pid = list(np.array(self.pid)[sub_indices])
-            self.target = list(np.array(self.target)[sub_indices])
+            self.target = [convert[self.target[i]] for i in sub_indices]
             self.len = len(sub_indices)
+        else:
+            sub_indices = list(range(self.len))
 
         # get dates for s1 and s2
-        with open(os.path.join(folder, 'META', 'dates.json'), 'r') as file:
-            date_s1 = json.loads(file.read())
-
-        with open(os.path.join(folder.replace('s1_data', 's2_data'), 'META', 'dates.json'), 'r') as file:
-            date_s2 = json.loads(file.read())
-
-        # for sentinel 1
+        self.dates_s1 = index['dates_s1'].tolist()
+        self.date_positions_s1 = date_positions(self.dates_s1)
+        self.dates_s2 = index['dates_s2'].tolist()
+        self.date_positions_s2 = date_positions(self.dates_s2)
 
-        #self.dates_s1 = [date_s1[i] for i in self.pid]       
-        self.dates_s1 = [date_s1[str(i)] for i in range(len(date_s1))]   ##errrrr
-        #self.date_positions_s1 = [date_positions(i) for i in self.dates_s1]
-        self.date_positions_s1 = date_positions(self.dates_s1)             ##errrrr
-        # for sentinel 2
-        #self.dates_s2 = [date_s2[i] for i in self.pid]
-        self.dates_s2 = [date_s2[str(i)] for i in range(len(date_s2))]  ##errrrr
-        #self.date_positions_s2 = [date_positions(i) for i in self.dates_s2]
-        self.date_positions_s2 = date_positions(self.dates_s2)            ##errrrr
-
-
-        if self.extra_feature is not None:
-            with open(os.path.join(self.meta_folder, '{}.json'.format(extra_feature)), 'r') as file:
-                self.extra_ = json.loads(file.read())
-                
-        # add extra features 
+        # add extra features, normalised once into a Number_of_items x Number_of_features array
         if self.extra_feature is not None:
-            with open(os.path.join(self.meta_folder, '{}.json'.format(extra_feature)), 'r') as file:
-                self.extra = json.loads(file.read())
-
-            if isinstance(self.extra[list(self.extra.keys())[0]], int):
-                for k in self.extra.keys():
-                    self.extra[k] = [self.extra[k]]                       
-         
-            df = pd.DataFrame(self.extra).transpose()                                                         
-            self.extra_m, self.extra_s = np.array(df.mean(axis=0)), np.array(df.std(axis=0))                                                      
+            self.extra_m, self.extra_s = index['extra_m'], index['extra_s']
+            self.extra = ((index['extra'][sub_indices] - self.extra_m) / self.extra_s).astype(np.float32)
+
+        # pixel sampling lookup tables and reused buffers (see sample_pixels)
+        self._mask_table = (np.arange(self.npixel)[None, :] < np.arange(self.npixel + 1)[:, None]).astype(np.float32)
+        self._pad_index = {}
+        self._buffers = {}
+
+        # float32 normalisation statistics, broadcastable to the (Batch_size x) Sequence_length x Channels x npixel
+        # parcels, and date tensors shared by all the samples
+        self._norm_s1 = norm_arrays(self.norm_s1)
+        self._norm_s2 = norm_arrays(self.norm_s2)
+        self._dates_s1_t = torch.tensor(self.date_positions_s1, dtype=torch.float32)
+        self._dates_s2_t = torch.tensor(self.date_positions_s2, dtype=torch.float32)
+
+        # S1 acquisitions matched (or interpolation weights) to the S2 dates, computed once for the full S2 sequence
+        self._s1_match = {}
+        self._s1_interp = {}
+        if (self.fusion_type == 'early' or self.fusion_type == 'pse') and self.interpolate_method == 'nn':
+            self.match_s1_dates(self.date_positions_s2)
+        elif (self.fusion_type == 'early' or self.fusion_type == 'pse') and self.interpolate_method == 'linear':
+            self.s1_interpolation(self.date_positions_s2)
 
     # get similar day-of-year in s1 for s2
-    def similar_sequence(self, input_s1, input_s2):
+    @staticmethod
+    def similar_sequence(input_s1, input_s2):
         input_s1 = np.asarray(input_s1)
         input_s2 = np.asarray(input_s2)
 
@@ -129,22 +128,184 @@ class PixelSetData(data.Dataset):
         return output_doy    
     
 
-    # interpolate s1 at s2 date
+    # interpolate s1 at s2 date (all channels and pixels at once)
     def interpolate_s1(self, arr_3d, s1_date, s2_date):
-        num_pixels = arr_3d.shape[-1]
-        vv = arr_3d[:,0,:]
-        vh = arr_3d[:,1,:]
+        return interpolate(arr_3d, *interpolation_weights(s1_date, s2_date))
+
+    def s1_interpolation(self, s2_item_date):
+        """ Interpolation weights from the Sentinel-1 dates to the given Sentinel-2 dates, memoized per S2 subset. """
+        key = tuple(s2_item_date)
+        if key not in self._s1_interp:
+            self._s1_interp[key] = interpolation_weights(self.date_positions_s1, s2_item_date)
+        return self._s1_interp[key]
+
+    def match_s1_dates(self, s2_item_date):
+        """
+        Returns the indices of the Sentinel-1 acquisitions matched to the given Sentinel-2 dates ('nn' method).
+        The matching only depends on the S2 dates subset, so it is memoized per distinct subset.
+        """
+        key = tuple(s2_item_date)
+        if key not in self._s1_match:
+            s1 = np.asarray(self.date_positions_s1)
+            nearest = nearest_index(s1, s2_item_date)
+
+            # when every S2 date has its own nearest S1 date, it is also the one picked by the greedy similar_sequence
+            if nearest is not None and len(np.unique(nearest)) == len(nearest):
+                output_doy = s1[nearest]
+            else:
+                output_doy = self.similar_sequence(input_s1 = s1, input_s2 = s2_item_date)
+
+            # get index of subset sequence
+            self._s1_match[key] = np.flatnonzero(np.isin(s1, output_doy))
+        return self._s1_match[key]
+
+    def load_parcel(self, item):
+        """ Returns the raw Sentinel-1 and Sentinel-2 arrays (Sequence_length x Channels x npixel) of an item. """
+        if self.store_s1 is not None:
+            return self.store_s1.get(self.pid[item]), self.store_s2.get(self.pid[item])
+        x0 = np.load(os.path.join(self.folder, 'DATA', '{}.npy'.format(self.pid[item])))
+        x00 = np.load(os.path.join(self.folder.replace('s1_data', 's2_data'), 'DATA', '{}.npy'.format(self.pid[item])))
+        return x0, x00
+
+    def sample_pixels(self, x0, x00):
+        """
+        Draws npixel pixels from the Sentinel-1 and Sentinel-2 parcels. Parcels with too few pixels are padded by
+        repeating their first pixel, empty parcels are zero-filled with a single valid pixel in the mask.
+        The sampled arrays are written into buffers that are reused from one call to the next, so they must be
+        copied (e.g. by the normalisation) before being handed out.
+        Returns:
+            x, x2 : Sequence_length x Channels x npixel arrays
+            mask1, mask2 : npixel pixel masks
+        """
+        n1, n2 = x0.shape[-1], x00.shape[-1]
+        idx = self._pixel_index(n1)
+        # S2 takes the same pixels as S1 whenever it has them (the early and convlstm fusions pair them up)
+        idx2 = idx if n2 == n1 or n2 > n1 >= self.npixel else self._pixel_index(n2)
+
+        x = self._take_pixels(x0, idx, 's1')
+        x2 = self._take_pixels(x00, idx2, 's2')
+        return x, x2, self._mask_table[max(min(n1, self.npixel), 1)], self._mask_table[max(min(n2, self.npixel), 1)]
+
+    def _pixel_index(self, n):
+        # npixel pixel indices of a parcel: a random subset of its pixels if it has more than npixel, otherwise all
+        # of them, then the first one repeated
+        if n > self.npixel:
+            return np.random.choice(n, size=self.npixel, replace=False)
+        if n not in self._pad_index:
+            self._pad_index[n] = np.concatenate([np.arange(n), np.zeros(self.npixel - n, dtype=int)])
+        return self._pad_index[n]
+
+    def _take_pixels(self, x, idx, key):
+        key = (key, x.shape[:2], x.dtype)
+        if key not in self._buffers:
+            self._buffers[key] = np.empty((*x.shape[:2], self.npixel), dtype=x.dtype)
+        out = self._buffers[key]
+        if x.shape[-1] == 0:
+            out.fill(0)
+        else:
+            np.take(x, idx, axis=2, out=out)
+        return out
+
+    def collate_fn(self, batch):
+        """
+        Collates the raw items yielded in batch_collate mode. Pixel sampling, normalisation, jitter and the S1/S2 date
+        matching are applied to the whole Batch_size x Sequence_length x Channels x npixel tensors at once.
+        The output has the same structure as the default collation of the items yielded by __getitem__, except for
+        the dates: date grids shared by all the items are returned once (Sequence_length) rather than per sample.
+        Datasets concatenated in a single loader must share the same settings and date grids.
+        """
+        x0, x00, s2_dates, y, pid, ef = zip(*batch)
+
+        x, x2, n1, n2 = self._sample_batch(x0, x00)
+        x = normalize_batch(x, self._norm_s1)
+        x2 = normalize_batch(x2, self._norm_s2)
+
+        if self.jitter is not None:
+            sigma, clip = self.jitter
+            x = x + torch.clamp(sigma * torch.randn_like(x), -1 * clip, clip)
+            x2 = x2 + torch.clamp(sigma * torch.randn_like(x2), -1 * clip, clip)
+
+        mask1 = self._batch_mask(n1).unsqueeze(1).expand(-1, x.shape[1], -1)
+        mask2 = self._batch_mask(n2).unsqueeze(1).expand(-1, x2.shape[1], -1).contiguous()
 
-        # interpolate per pixel in parcel per time
-        vv_interp = np.column_stack([np.interp(s2_date, s1_date, vv[:,i]) for i in range(num_pixels)])
-        vh_interp = np.column_stack([np.interp(s2_date, s1_date, vh[:,i]) for i in range(num_pixels)])
+        s2_dates = torch.tensor(np.array(s2_dates), dtype=torch.float32)
 
-        # stack vv and vh
-        res = np.concatenate((np.expand_dims(vv_interp, 1), np.expand_dims(vh_interp, 1)), axis = 1)
+        # interpolate s1 at s2 date
+        if self.fusion_type == 'early' or self.fusion_type == 'pse':
+            batch_idx = torch.arange(len(batch)).unsqueeze(1)
+
+            if self.interpolate_method == 'nn':
+                x_idx = torch.from_numpy(np.stack([self.match_s1_dates(d) for d in s2_dates.tolist()]))
+                x = x[batch_idx, x_idx]
+                mask1 = mask1[:, :x_idx.shape[1]]
+
+            elif self.interpolate_method == 'linear':
+                weights = [self.s1_interpolation(d) for d in s2_dates.tolist()]
+                x = interpolate(x, *(np.stack(a) for a in zip(*weights)))
+                mask1 = mask1[:, :s2_dates.shape[1]]
+        mask1 = mask1.contiguous()
+
+        data = [x, mask1]
+        data2 = [x2, mask2]
+
+        if self.extra_feature is not None:
+            ef = torch.from_numpy(np.stack(ef)).unsqueeze(1)
+            data = [data, ef.expand(-1, x.shape[1], -1).contiguous()]
+            data2 = [data2, ef.expand(-1, x2.shape[1], -1).contiguous()]
+
+        y = torch.tensor(np.array(y, dtype=int))
+        if self.minimum_sampling is None:
+            dates = [self._dates_s1_t, self._dates_s2_t]
+        else:
+            dates = [self._dates_s1_t, s2_dates]
+        if self.return_id:
+            return data, data2, y, dates, list(pid)
+        else:
+            return data, data2, y, dates
+
+    def _sample_batch(self, x0, x00):
+        """
+        Samples npixel pixels from each of the raw Sequence_length x Channels x N parcels of both sensors.
+        Parcels with more than npixel pixels are sampled without replacement, the others keep their pixels in order
+        and are padded with their first pixel (empty parcels are zero-filled). As in sample_pixels, an S2 parcel takes
+        the same pixels as its S1 parcel whenever it has them.
+        Returns:
+            Batch_size x Sequence_length x Channels x npixel tensors of both sensors, number of pixels of each parcel
+        """
+        n1 = torch.tensor([p.shape[-1] for p in x0], dtype=torch.long)
+        n2 = torch.tensor([p.shape[-1] for p in x00], dtype=torch.long)
+        idx = self._batch_index(n1)
+        shared = (n2 == n1) | ((n2 > n1) & (n1 >= self.npixel))
+        idx2 = idx if bool(shared.all()) else torch.where(shared.unsqueeze(1), idx, self._batch_index(n2))
+        return self._gather_pixels(x0, idx), self._gather_pixels(x00, idx2), n1, n2
+
+    def _batch_index(self, n):
+        # random keys for the sampled parcels, ordered keys for the padded ones, invalid pixels last
+        n_max = max(int(n.max()), self.npixel)
+        position = torch.arange(n_max).expand(len(n), -1)
+        keys = torch.where((n > self.npixel).unsqueeze(1), torch.rand(len(n), n_max), position / n_max)
+        keys = keys.masked_fill(position >= n.unsqueeze(1), 2.)
+        idx = keys.argsort(dim=1)[:, :self.npixel]
+        return torch.where(position[:, :self.npixel] < n.unsqueeze(1), idx, idx[:, :1])
+
+    def _gather_pixels(self, parcels, idx):
+        # the sampled pixels of each parcel taken straight into a Batch_size x Sequence_length x Channels x npixel
+        # buffer (empty parcels stay zero-filled), so that the cost does not grow with the size of the parcels
+        t, c = parcels[0].shape[:2]
+        out = np.zeros((len(parcels), t, c, self.npixel), dtype=np.float32)
+        idx = idx.numpy()
+        for b, p in enumerate(parcels):
+            if p.shape[-1] == 0:
+                continue
+            if p.dtype == np.float32:
+                np.take(p, idx[b], axis=2, out=out[b])
+            else:
+                out[b] = p[:, :, idx[b]]
+        return torch.from_numpy(out)
+
+    def _batch_mask(self, n):
+        return torch.from_numpy(self._mask_table)[torch.clamp(n, 1, self.npixel)]
 
-        return res   
-  
-  
     def pid_shape_e(self):
         return self.pid_shape
     
@@ -166,8 +327,7 @@ class PixelSetData(data.Dataset):
         """
         # loader for x0 = x = sentinel1 and x00 = x2 = sentinel2
 
-        x0 = np.load(os.path.join(self.folder, 'DATA', '{}.npy'.format(self.pid[item])))
-        x00 = np.load(os.path.join(self.folder.replace('s1_data', 's2_data'), 'DATA', '{}.npy'.format(self.pid[item])))
+        x0, x00 = self.load_parcel(item)
         y = self.target[item]
         
         #s1_item_date = self.date_positions_s1[item] 
@@ -186,145 +346,293 @@ class PixelSetData(data.Dataset):
             # subset dates using sampling idx.
             s2_item_date = [s2_item_date[i] for i in indices]  
             
+        if self.batch_collate:
+            ef = self.extra[item] if self.extra_feature is not None else None
+            return x0, x00, s2_item_date, y, self.pid[item], ef
         
-        if x0.shape[-1] > self.npixel:
-            idx = np.random.choice(list(range(x0.shape[-1])), size=self.npixel, replace=False)
-            x = x0[:, :, idx]
-            x2 = x00[:, :, idx]
-            mask1, mask2 = np.ones(self.npixel), np.ones(self.npixel)
-
-        elif x0.shape[-1] < self.npixel:
-
-            if x0.shape[-1] == 0:
-                x = np.zeros((*x0.shape[:2], self.npixel))
-                x2 = np.zeros((*x00.shape[:2], self.npixel))
-                mask1, mask2 = np.zeros(self.npixel), np.zeros(self.npixel)
-                mask1[0], mask2[0] = 1, 1
-            else:
-                x = np.zeros((*x0.shape[:2], self.npixel))
-                x2 = np.zeros((*x00.shape[:2], self.npixel))
-                
-                x[:, :, :x0.shape[-1]] = x0
-                x2[:, :, :x00.shape[-1]] = x00
-                
-                x[:, :, x0.shape[-1]:] = np.stack([x[:, :, 0] for _ in range(x0.shape[-1], x.shape[-1])], axis=-1)
-                x2[:, :, x00.shape[-1]:] = np.stack([x2[:, :, 0] for _ in range(x00.shape[-1], x2.shape[-1])], axis=-1)
-                mask1 = np.array(
-                    [1 for _ in range(x0.shape[-1])] + [0 for _ in range(x0.shape[-1], self.npixel)])
-                mask2 = np.array(
-                    [1 for _ in range(x00.shape[-1])] + [0 for _ in range(x00.shape[-1], self.npixel)])
-        else:
-            x = x0
-            x2 = x00
-            mask1, mask2 = np.ones(self.npixel), np.ones(self.npixel)
-
-        if self.norm_s1 is not None:
-            m1, s1 = self.norm_s1
-            m1 = np.array(m1)
-            s1 = np.array(s1)
-            
-            if len(m1.shape) == 0:
-                x = (x - m1) / s1
-            elif len(m1.shape) == 1:  # Normalise channel-wise
-                x = (x.swapaxes(1, 2) - m1) / s1
-                x = x.swapaxes(1, 2)  # Normalise channel-wise for each date
-            elif len(m1.shape) == 2:
-                x = np.rollaxis(x, 2)  # TxCxS -> SxTxC
-                x = (x - m1) / s1
-                x = np.swapaxes((np.rollaxis(x, 1)), 1, 2)
-                
-        if self.norm_s2  is not None:
-            m2, s2 = self.norm_s2
-            m2 = np.array(m2)
-            s2 = np.array(s2)
-
-            if len(m2.shape) == 0:
-                x2 = (x2 - m2) / s2
-            elif len(m2.shape) == 1:  # Normalise channel-wise
-                x2 = (x2.swapaxes(1, 2) - m2) / s2
-                x2 = x2.swapaxes(1, 2)  # Normalise channel-wise for each date
-            elif len(m2.shape) == 2:
-                x2 = np.rollaxis(x2, 2)  # TxCxS -> SxTxC
-                x2 = (x2 - m2) / s2
-                x2 = np.swapaxes((np.rollaxis(x2, 1)), 1, 2)                
-                
-                
-        x = x.astype('float')
-        x2 = x2.astype('float')
+        x, x2, mask1, mask2 = self.sample_pixels(x0, x00)
+
+        # normalise into new float32 arrays (the sampled arrays are reused buffers)
+        x = normalize(x, self._norm_s1)
+        x2 = normalize(x2, self._norm_s2)
 
         if self.jitter is not None:
             sigma, clip = self.jitter
-            x = x + np.clip(sigma * np.random.randn(*x.shape), -1 * clip, clip)
-            x2 = x2 + np.clip(sigma * np.random.randn(*x2.shape), -1 * clip, clip)
+            x += np.clip(sigma * np.random.randn(*x.shape), -1 * clip, clip)
+            x2 += np.clip(sigma * np.random.randn(*x2.shape), -1 * clip, clip)
 
-        mask1 = np.stack([mask1 for _ in range(x.shape[0])], axis=0)  # Add temporal dimension to mask
-        mask2 = np.stack([mask2 for _ in range(x2.shape[0])], axis=0)
+        mask1 = np.tile(mask1, (x.shape[0], 1))  # Add temporal dimension to mask
+        mask2 = np.tile(mask2, (x2.shape[0], 1))
 
 
         # interpolate s1 at s2 date
         if self.fusion_type == 'early' or self.fusion_type == 'pse':
         
             if self.interpolate_method == 'nn':
-                output_doy = self.similar_sequence(input_s1 = s1_item_date, input_s2 = s2_item_date)
-
-                # get index of subset sequence
-                x_idx = [i for i in range(len(s1_item_date)) if self.date_positions_s1[i] in output_doy]
+                x_idx = self.match_s1_dates(s2_item_date)
                 x = x[x_idx, :, :]
                 mask1 = mask1[x_idx,:]
             
             elif self.interpolate_method == 'linear':
-                x = self.interpolate_s1(arr_3d = x, s1_date = s1_item_date, s2_date = s2_item_date)
+                x = interpolate(x, *self.s1_interpolation(s2_item_date))
                 mask1 = mask1[:len(s2_item_date), :] # slice to length of s2_sequence
 
     
-        # create tensor from numpy
-        data = (Tensor(x), Tensor(mask1))
-        data2 = (Tensor(x2), Tensor(mask2))
+        # create tensor from numpy (no copy)
+        data = (to_tensor(x), torch.from_numpy(mask1))
+        data2 = (to_tensor(x2), torch.from_numpy(mask2))
 
         if self.extra_feature is not None:
-        
-            
-            
-            ef = (self.extra[str(self.pid[item])] - self.extra_m) / self.extra_s
-            
-            
-            ef = torch.from_numpy(ef).float()
-                      
-
-            ef = torch.stack([ef for _ in range(data[0].shape[0])], dim=0)
-            
-            data = (data, ef)
-
-            ef2 = (self.extra[str(self.pid[item])] - self.extra_m) / self.extra_s  ###errrrrr
-            ef2 = torch.from_numpy(ef2).float()                                      ###errrrrr                     
-
-            ef2 = torch.stack([ef2 for _ in range(data2[0].shape[0])], dim=0)   ###errrrrr
-            data2 = (data2, ef2)                                               ###errrrrr
-            
+            # same features for all the dates, broadcast without copy
+            ef = torch.from_numpy(self.extra[item])
+            data = (data, ef.expand(data[0].shape[0], -1))
+            data2 = (data2, ef.expand(data2[0].shape[0], -1))
 
+        dates = (self._dates_s1_t, self._dates_s2_t if self.minimum_sampling is None else Tensor(s2_item_date))
         if self.return_id :
-            return data, data2, torch.from_numpy(np.array(y, dtype=int)), (Tensor(s1_item_date), Tensor(s2_item_date)), self.pid[item]
+            return data, data2, torch.from_numpy(np.array(y, dtype=int)), dates, self.pid[item]
             #return data, data2 , torch.from_numpy(np.array(y, dtype=int)),self.pid[item]
         else:
-            return data, data2, torch.from_numpy(np.array(y, dtype=int)), (Tensor(s1_item_date), Tensor(s2_item_date)) 
+            return data, data2, torch.from_numpy(np.array(y, dtype=int)), dates
             #return data, data2, torch.from_numpy(np.array(y, dtype=int))
 
 
 class PixelSetData_preloaded(PixelSetData):
     """ Wrapper class to load all the dataset to RAM at initialization (when the hardware permits it).
+    The raw parcels are held in one shared-memory arena per sensor (see parcel_store.ParcelArena), so the pixel
+    sampling and jitter are redrawn at every epoch and DataLoader workers do not duplicate the data.
     """
     def __init__(self, folder, labels, npixel, sub_classes=None, norm_s1=None, norm_s2=None,
-                 extra_feature=None, jitter=(0.01, 0.05), minimum_sampling=27, interpolate_method ='nn', return_id=False, fusion_type=None):
-        super(PixelSetData_preloaded, self).__init__(folder, labels, npixel, sub_classes, norm_s1, norm_s2, extra_feature, jitter, minimum_sampling, interpolate_method, return_id, fusion_type)
+                 extra_feature=None, jitter=(0.01, 0.05), minimum_sampling=27, interpolate_method ='nn', return_id=False, fusion_type=None,
+                 packed=False, batch_collate=False):
+        super(PixelSetData_preloaded, self).__init__(folder, labels, npixel, sub_classes, norm_s1, norm_s2, extra_feature, jitter, minimum_sampling, interpolate_method, return_id, fusion_type, packed, batch_collate)
         
-        self.samples = []
         print('Loading samples to memory . . .')
-        for item in range(len(self)):
-            self.samples.append(super(PixelSetData_preloaded, self).__getitem__(item))
+        self.store_s1 = ParcelArena(folder, pid=self.pid)
+        self.store_s2 = ParcelArena(folder.replace('s1_data', 's2_data'), pid=self.pid)
         print('Done !')
 
-    def __getitem__(self, item):
-        return self.samples[item]
+
+class PixelSetStream(data.IterableDataset):
+    """
+    Streams the items of any number of packed split folders (see parcel_store.py), for training sets that do not fit
+    in RAM. Each folder is cut into shards of consecutive parcels, which are read sequentially from the memory-mapped
+    store. Shards are shuffled at every epoch and dealt out to the DataLoader workers, and items are shuffled across
+    shards through a bounded buffer.
+    """
+    def __init__(self, folders, labels, npixel, shard_size=1024, shuffle=True, buffer_size=4096, **kwargs):
+        """
+        Args:
+            folders (list): paths to the s1_data folders to stream (all packed)
+            labels (str): name of the nomenclature to use in the labels.json files
+            npixel (int): Number of sampled pixels in each parcel
+            shard_size (int): Number of consecutive parcels in a shard
+            shuffle (bool): if True, shards and items are shuffled (training)
+            buffer_size (int): Number of items held in the shuffle buffer
+            kwargs: other arguments of PixelSetData, shared by all the folders
+        """
+        super(PixelSetStream, self).__init__()
+        self.datasets = [PixelSetData(f, labels, npixel, packed=True, **kwargs) for f in folders]
+        self.shards = [(d, start, min(start + shard_size, len(dataset)))
+                       for d, dataset in enumerate(self.datasets) for start in range(0, len(dataset), shard_size)]
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+
+    def __len__(self):
+        return sum(len(d) for d in self.datasets)
+
+    @property
+    def collate_fn(self):
+        return self.datasets[0].collate_fn
+
+    def __iter__(self):
+        worker = data.get_worker_info()
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            # the shard order must be the same in all the workers: it is drawn from the base seed of the epoch
+            seed = np.random.randint(2 ** 31) if worker is None else (worker.seed - worker.id) % 2 ** 32
+            order = np.random.RandomState(seed).permutation(order)
+        if worker is not None:
+            order = order[worker.id::worker.num_workers]
+
+        buffer = []
+        for s in order:
+            d, start, end = self.shards[s]
+            for item in range(start, end):
+                sample = self.datasets[d][item]
+                if not self.shuffle:
+                    yield sample
+                elif len(buffer) < self.buffer_size:
+                    buffer.append(sample)
+                else:
+                    i = np.random.randint(len(buffer))
+                    yield buffer[i]
+                    buffer[i] = sample
+        for i in np.random.permutation(len(buffer)):
+            yield buffer[i]
+
+
+def norm_arrays(norm):
+    """ (mean, std) statistics as float32 arrays broadcastable to (Batch_size x) Sequence_length x Channels x npixel. """
+    if norm is None:
+        return None
+    m, s = (np.array(a, dtype=np.float32) for a in norm)
+    if len(m.shape) == 1:  # channel-wise
+        m, s = m[:, None], s[:, None]
+    elif len(m.shape) == 2:  # channel-wise for each date
+        m, s = m[:, :, None], s[:, :, None]
+    return m, s
+
+
+def normalize(x, norm):
+    """ Normalised float32 copy of a Sequence_length x Channels x npixel array. """
+    if norm is None:
+        return x.astype(np.float32)
+    m, s = norm
+    out = np.subtract(x, m, dtype=np.float32)
+    return np.divide(out, s, out=out)
+
+
+def normalize_batch(x, norm):
+    if norm is None:
+        return x.contiguous()
+    m, s = norm
+    # written to a contiguous output: x is a permuted view and the PSE flattens the batch and time dimensions
+    out = torch.sub(x, torch.from_numpy(m), out=torch.empty(x.shape, dtype=torch.float32))
+    return out.div_(torch.from_numpy(s))
+
+
+def to_tensor(x):
+    # float32 tensor sharing the memory of x when it is already a contiguous float32 array
+    return torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+
+
+def nearest_index(src_dates, dst_dates):
+    """
+    Index of the nearest src date of each dst date (the earliest one in case of a tie), or None if the src dates are
+    not strictly increasing.
+    """
+    src = np.asarray(src_dates, dtype=float)
+    dst = np.asarray(dst_dates, dtype=float)
+    if len(src) < 2 or np.any(np.diff(src) <= 0):
+        return None
+    right = np.clip(np.searchsorted(src, dst), 1, len(src) - 1)
+    left = right - 1
+    return np.where(np.abs(dst - src[left]) <= np.abs(src[right] - dst), left, right)
+
+
+def interpolation_weights(src_dates, dst_dates):
+    """
+    Linear interpolation from the src_dates to the dst_dates grid, with the same clamping as np.interp.
+    Returns:
+        i0, i1 (arrays): indices of the src dates surrounding each dst date
+        w (array): weight of i1 in the interpolation
+    """
+    src = np.asarray(src_dates, dtype=float)
+    if len(src) == 1:
+        zeros = np.zeros(len(dst_dates), dtype=int)
+        return zeros, zeros, zeros.astype(float)
+    dst = np.clip(np.asarray(dst_dates, dtype=float), src[0], src[-1])
+    i1 = np.clip(np.searchsorted(src, dst, side='right'), 1, len(src) - 1)
+    i0 = i1 - 1
+    w = (dst - src[i0]) / (src[i1] - src[i0])
+    return i0, i1, w
+
+
+def interpolate(x, i0, i1, w):
+    """
+    Applies precomputed interpolation weights (see interpolation_weights) along the temporal axis with a single
+    gather-and-blend, for all channels and pixels.
+    Args:
+        x: Sequence_length x Channels x npixel array, or Batch_size x Sequence_length x Channels x npixel tensor
+        i0, i1, w: weights of the output dates, shared by the batch (Output_length) or per sample
+            (Batch_size x Output_length)
+    """
+    if torch.is_tensor(x):
+        i0, i1 = torch.as_tensor(i0), torch.as_tensor(i1)
+        w = torch.as_tensor(w).to(x.dtype)[..., None, None]
+        if i0.dim() == 1:
+            return x[:, i0] * (1 - w) + x[:, i1] * w
+        batch_idx = torch.arange(x.shape[0]).unsqueeze(1)
+        return x[batch_idx, i0] * (1 - w) + x[batch_idx, i1] * w
+
+    w = w.astype(x.dtype)[:, None, None]
+    return x[i0] * (1 - w) + x[i1] * w
+
+
+INDEX_VERSION = 1
+
+
+def load_index(folder, labels, extra_feature=None, pid=None):
+    """
+    Parcel ids, labels, dates and extra features of a split folder, as arrays.
+    The index is cached in META/index_<labels>_<extra_feature>.npz and rebuilt whenever one of the source files
+    (DATA directory, labels.json, dates.json of both sensors, extra feature file, packed index) changes in mtime or size.
+    Args:
+        folder (str): path to the s1_data folder of the split
+        labels (str): name of the nomenclature to use in the labels.json file
+        extra_feature (str, optional): name of the additional static feature file to use
+        pid (array, optional): parcel ids, if already known (e.g. from a packed store)
+    Returns:
+        dict with pid, target, dates_s1, dates_s2 and (if extra_feature) extra, extra_m and extra_s arrays
+    """
+    meta_folder = os.path.join(folder, 'META')
+    sources = [os.path.join(folder, 'DATA'),
+               os.path.join(meta_folder, 'labels.json'),
+               os.path.join(meta_folder, 'dates.json'),
+               os.path.join(folder.replace('s1_data', 's2_data'), 'META', 'dates.json'),
+               os.path.join(folder, 'PACKED', 'index.npz')]
+    if extra_feature is not None:
+        sources.append(os.path.join(meta_folder, '{}.json'.format(extra_feature)))
+    signature = json.dumps([INDEX_VERSION] + [(f, os.stat(f).st_mtime_ns, os.stat(f).st_size)
+                                              for f in sources if os.path.exists(f)])
+    cache = os.path.join(meta_folder, 'index_{}_{}.npz'.format(labels, extra_feature))
+
+    if os.path.isfile(cache):
+        try:
+            with np.load(cache) as f:
+                if str(f['signature']) == signature:
+                    return dict(f)
+        except (zipfile.BadZipFile, OSError, EOFError, KeyError, ValueError):
+            pass  # unreadable cache (e.g. truncated by an interrupted write), rebuilt below
+
+    # build the index from the source files
+    if pid is None:
+        pid = np.sort([int(f.name.split('.')[0]) for f in os.scandir(os.path.join(folder, 'DATA'))
+                       if f.name.endswith('.npy')])
+    index = {'signature': np.array(signature), 'pid': np.asarray(pid, dtype=np.int64)}
+
+    with open(os.path.join(meta_folder, 'labels.json'), 'r') as file:
+        d = json.loads(file.read())[labels]
+    index['target'] = np.array([d[str(p)] for p in index['pid']], dtype=np.int64)
+
+    for sensor, f in (('s1', sources[2]), ('s2', sources[3])):
+        with open(f, 'r') as file:
+            dates = json.loads(file.read())
+        index['dates_' + sensor] = np.array([dates[str(i)] for i in range(len(dates))], dtype=np.int64)
+
+    if extra_feature is not None:
+        with open(sources[-1], 'r') as file:
+            extra = json.loads(file.read())
+        keys = list(extra.keys())
+        values = np.array([np.atleast_1d(extra[k]) for k in keys], dtype=float)
+        position = dict((k, i) for i, k in enumerate(keys))
+        index['extra'] = values[[position[str(p)] for p in index['pid']]]
+        index['extra_m'], index['extra_s'] = values.mean(axis=0), values.std(axis=0, ddof=1)
+
+    # written to a temporary file of this process and moved into place, so that readers (and the other processes
+    # building the same index) never see a partial file
+    tmp = '{}.{}.tmp'.format(cache, os.getpid())
+    try:
+        with open(tmp, 'wb') as file:
+            np.savez(file, **index)
+        os.replace(tmp, cache)
+    except OSError:
+        pass  # read-only dataset folder, the index is rebuilt next time
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return index
 
 
 def parse(date):
@@ -0,0 +1,124 @@
+"""
+Multi-process data-parallel training (DistributedDataParallel, gloo backend)
+
+launch(main, args) runs main(args) in args['nproc'] worker processes of this host, each with its own rank, and one
+process per core group (the intra-op threads are divided between them). To train on several hosts, the same command is
+run on each of them with the environment variables:
+    MASTER_ADDR, MASTER_PORT : address and free port of the host of rank 0
+    NNODES, NODE_RANK        : number of hosts and index of this host
+Workers started by torchrun (RANK, WORLD_SIZE and LOCAL_RANK set) are used as they are.
+
+The helpers below are no-ops in a single process.
+"""
+
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def launch(main, args):
+    """
+    Args:
+        main (function): training function, called with args in every worker
+        args (dict): arguments of main, with the number of workers of this host in args['nproc']
+    """
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:  # torchrun
+        worker(int(os.environ.get('LOCAL_RANK', 0)), main, args)
+    elif args['nproc'] > 1 or int(os.environ.get('NNODES', 1)) > 1:
+        mp.spawn(worker, args=(main, args), nprocs=args['nproc'])
+    else:
+        main(args)
+
+
+def worker(local_rank, main, args):
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        rank, world_size = int(os.environ['RANK']), int(os.environ['WORLD_SIZE'])
+        local_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    else:
+        nnodes, node_rank = int(os.environ.get('NNODES', 1)), int(os.environ.get('NODE_RANK', 0))
+        rank, world_size, local_size = node_rank * args['nproc'] + local_rank, nnodes * args['nproc'], args['nproc']
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_size))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        main(args)
+    finally:
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+    """ True in the process that writes the checkpoints and results (rank 0). """
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_buffers(module, src=0):
+    """
+    Copies the buffers of the module (BatchNorm running statistics) of rank src to the other ranks. DDP only
+    broadcasts them at the start of each training forward, so after the last step every rank keeps the statistics of
+    its own last batch.
+    """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for b in module.buffers():
+            buffer = b.cpu()
+            dist.broadcast(buffer, src)
+            b.copy_(buffer)
+
+
+def broadcast_object(obj, src=0):
+    """ Returns obj of rank src in every rank (e.g. a checkpoint that only rank src can read). """
+    if not is_distributed():
+        return obj
+    objects = [obj if get_rank() == src else None]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
+
+
+def reduce_meters(*meters):
+    """
+    Sums the statistics of AverageValueMeter and ConfusionMatrixMeter (learning/metrics.py) meters over the ranks (in
+    place), so that their values are those of the whole epoch.
+    """
+    if not is_distributed():
+        return
+    for meter in meters:
+        if hasattr(meter, 'mat'):
+            n = meter.n_classes + 1
+            mat = meter.mat.cpu() if meter.mat is not None else torch.zeros(n * n + 1, dtype=torch.long)
+            dist.all_reduce(mat)
+            meter.mat = mat
+        else:
+            totals = torch.tensor([meter.sum, meter.n], dtype=torch.float64)
+            dist.all_reduce(totals)
+            meter.sum, meter.n = totals[0].item(), int(totals[1].item())
+            meter.mean = meter.sum / meter.n if meter.n > 0 else float('nan')
+
+
+def gather_lists(*lists):
+    """ Returns the concatenation over the ranks of each list (in rank order). """
+    if not is_distributed():
+        return lists
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, lists)
+    return tuple([v for rank_lists in gathered for v in rank_lists[i]] for i in range(len(lists)))
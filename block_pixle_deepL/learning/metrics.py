@@ -1,5 +1,27 @@
 import numpy as np
-import pandas as pd
+import torch
+
+
+def confusion_matrix_bincount(y_true, y_pred, n_classes):
+    """
+    Confusion matrix computed with one bincount, with an extra row/column counting the labels outside
+    [0, n_classes) (rows: true labels).
+    Args:
+        y_true (1D-array): True labels
+        y_pred (1D-array): Predicted labels
+        n_classes (int): Total number of classes
+    Returns:
+        (n_classes + 1) x (n_classes + 1) matrix (int64 array)
+    """
+    n = n_classes + 1
+    labels = []
+    for y in (y_true, y_pred):
+        y = np.asarray(y).reshape(-1)
+        inside = (y >= 0) & (y < n_classes)
+        if not np.issubdtype(y.dtype, np.integer):
+            inside &= y == np.floor(y)
+        labels.append(np.where(inside, y, n_classes).astype(np.int64))
+    return np.bincount(n * labels[0] + labels[1], minlength=n * n).reshape(n, n)
 
 
 def mIou(y_true, y_pred, n_classes):
@@ -14,22 +36,14 @@ def mIou(y_true, y_pred, n_classes):
     Returns:
         mean Iou (float)
     """
-    iou = 0
-    n_observed = n_classes
-    for i in range(n_classes):
-        y_t = (np.array(y_true) == i).astype(int)
-        y_p = (np.array(y_pred) == i).astype(int)
-
-        inter = np.sum(y_t * y_p)
-        union = np.sum((y_t + y_p > 0).astype(int))
-
-        if union == 0:
-            n_observed -= 1
-        else:
-            iou += inter / union
-
-    return iou / n_observed
+    mat = confusion_matrix_bincount(y_true, y_pred, n_classes)
+    inter = np.diag(mat)[:-1]
+    union = mat.sum(axis=0)[:-1] + mat.sum(axis=1)[:-1] - inter
+    observed = union > 0
 
+    # summed in class order, as a running total
+    iou = sum(inter[observed] / union[observed], 0)
+    return iou / int(np.sum(observed))
 
 
 def confusion_matrix_analysis(mat):
@@ -45,36 +59,22 @@ def confusion_matrix_analysis(mat):
         overall (dict): overall metrics
 
     """
-    TP = 0
-    FP = 0
-    FN = 0
-    pre = 0
-
-    per_class = {}
-
-    for j in range(mat.shape[0]):
-        d = {}
-        tp = np.sum(mat[j, j])
-        fp = np.sum(mat[:, j]) - tp
-        fn = np.sum(mat[j, :]) - tp
-        probR = (np.sum(mat[j, :]))/(np.sum(mat))
-        probP = (np.sum(mat[:, j]))/(np.sum(mat))
-        chance = probR * probP
-
-        d['IoU'] = tp / (tp + fp + fn)
-        d['Precision'] = tp / (tp + fp)
-        d['Recall'] = tp / (tp + fn)
-        d['F1-score'] = 2 * tp / (2 * tp + fp + fn)
-
-        per_class[str(j)] = d
-
-        TP += tp
-        FP += fp
-        FN += fn
-        pre += chance
-
-    pra = np.sum(np.diag(mat)) / np.sum(mat)
-    
+    mat = np.asarray(mat)
+    total = np.sum(mat)
+    tp = np.diag(mat)
+    fp = np.sum(mat, axis=0) - tp
+    fn = np.sum(mat, axis=1) - tp
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = np.stack([tp / (tp + fp + fn), tp / (tp + fp), tp / (tp + fn), 2 * tp / (2 * tp + fp + fn)], axis=1)
+    names = ['IoU', 'Precision', 'Recall', 'F1-score']
+    per_class = dict((str(j), dict(zip(names, metrics[j]))) for j in range(mat.shape[0]))
+
+    TP, FP, FN = np.sum(tp), np.sum(fp), np.sum(fn)
+    # chance agreement summed in class order, as a running total
+    pre = sum((np.sum(mat, axis=1) / total) * (np.sum(mat, axis=0) / total), 0)
+    pra = np.sum(tp) / total
+
     overall = {}
     overall['micro_IoU'] = TP / (TP + FP + FN)
     overall['micro_Precision'] = TP / (TP + FP)
@@ -82,12 +82,90 @@ def confusion_matrix_analysis(mat):
     overall['micro_F1-score'] = 2 * TP / (2 * TP + FP + FN)
     overall['micro_Kappa'] = (pra-pre)/(1-pre)
 
-    macro = pd.DataFrame(per_class).transpose().mean()
-    overall['MACRO_IoU'] = macro.loc['IoU']
-    overall['MACRO_Precision'] = macro.loc['Precision']
-    overall['MACRO_Recall'] = macro.loc['Recall']
-    overall['MACRO_F1-score'] = macro.loc['F1-score']
+    # mean over the classes where the metric is defined, summed in the order of the pandas mean of the per-class table
+    # (running total over the classes, or pairwise over the nan-filled copy), so that the values are the same
+    defined = ~np.isnan(metrics)
+    if defined.all():
+        sums = np.sum(metrics, axis=0)
+    else:
+        sums = np.sum(np.ascontiguousarray(np.where(defined, metrics, 0).T), axis=1)
+    with np.errstate(invalid='ignore'):
+        macro = sums / np.sum(defined, axis=0)
+    for name, value in zip(names, macro):
+        overall['MACRO_{}'.format(name)] = value
 
     overall['Accuracy'] = np.sum(np.diag(mat)) / np.sum(mat)
 
     return per_class, overall
+
+
+class ConfusionMatrixMeter(object):
+    """
+    Streaming confusion matrix, accumulated on the device of the predictions with one bincount per batch, from which
+    the accuracy, mIoU, per-class F1-score and kappa of all the samples added since the last reset are derived.
+    Labels outside [0, n_classes) are counted in an extra row/column (and the samples whose true and predicted labels
+    are the same out-of-range label in a last counter), so that accuracy() and miou() match ClassErrorMeter and mIou on
+    the same samples; value() returns the n_classes x n_classes matrix (rows: true labels).
+    """
+
+    def __init__(self, n_classes):
+        self.n_classes = n_classes
+        self.reset()
+
+    def reset(self):
+        self.mat = None
+
+    def add(self, output, target):
+        """
+        Args:
+            output (Tensor): Batch_size x n_classes scores, or Batch_size predicted labels
+            target (Tensor): Batch_size true labels
+        """
+        n = self.n_classes + 1
+        pred = output.argmax(dim=1) if output.dim() > 1 else output
+        pred, target = pred.long().view(-1), target.to(pred.device).long().view(-1)
+        pred_in, target_in = (pred >= 0) & (pred < n - 1), (target >= 0) & (target < n - 1)
+        outside = ((pred == target) & ~target_in).sum().view(1)
+        pred = torch.where(pred_in, pred, n - 1)
+        target = torch.where(target_in, target, n - 1)
+        counts = torch.cat((torch.bincount(n * target + pred, minlength=n * n), outside))
+        self.mat = counts if self.mat is None else self.mat + counts
+
+    def full(self):
+        """ (n_classes + 1) x (n_classes + 1) matrix, as float64 numpy array (last row/column: out-of-range labels). """
+        n = self.n_classes + 1
+        if self.mat is None:
+            return np.zeros((n, n))
+        return self.mat[:n * n].view(n, n).cpu().numpy().astype(np.float64)
+
+    def value(self):
+        return self.full()[:-1, :-1].astype(np.int64)
+
+    def accuracy(self):
+        """ Overall accuracy, in percent. """
+        mat = self.full()
+        outside = self.mat[-1].item() if self.mat is not None else 0
+        return float(100. * (np.trace(mat[:-1, :-1]) + outside) / mat.sum())
+
+    def miou(self):
+        """ Mean IoU over the classes that appear in the true or predicted labels. """
+        mat = self.full()
+        tp = np.diag(mat)[:-1]
+        union = mat.sum(axis=0)[:-1] + mat.sum(axis=1)[:-1] - tp
+        observed = union > 0
+        return float(np.sum(tp[observed] / union[observed]) / np.sum(observed))
+
+    def f1(self):
+        """ Per-class F1-score (nan for classes absent from the true and predicted labels). """
+        mat = self.full()
+        tp = np.diag(mat)[:-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 2 * tp / (mat.sum(axis=0)[:-1] + mat.sum(axis=1)[:-1])
+
+    def kappa(self):
+        """ Cohen's kappa of the n_classes x n_classes matrix. """
+        mat = self.value().astype(np.float64)
+        total = mat.sum()
+        observed = np.trace(mat) / total
+        chance = np.sum(mat.sum(axis=0) * mat.sum(axis=1)) / total ** 2
+        return float((observed - chance) / (1 - chance))
@@ -0,0 +1,37 @@
+"""
+bfloat16 mixed precision
+
+Under autocast('bf16', device) the Linear layers and matrix products run in bfloat16 (AVX512-BF16 / AMX on CPU) while
+the weights, gradients and optimizer state stay in fp32. bfloat16 has the exponent range of fp32, so the gradients do
+not underflow and no loss scaling is needed. keep_norms_fp32 casts the inputs of the BatchNorm and LayerNorm layers back
+to fp32, so that their batch and running statistics are computed in fp32; the loss is computed outside autocast, on
+fp32 logits.
+"""
+
+import contextlib
+import torch
+import torch.nn as nn
+
+NORM_LAYERS = (nn.modules.batchnorm._BatchNorm, nn.LayerNorm)
+
+
+def autocast(precision, device):
+    """
+    Args:
+        precision (str): 'fp32' or 'bf16'
+        device (str or torch.device): device the model runs on
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    elif precision == 'bf16':
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    raise ValueError('Unknown precision {}'.format(precision))
+
+
+def to_fp32(module, input):
+    return tuple(x.float() if isinstance(x, torch.Tensor) and x.is_floating_point() else x for x in input)
+
+
+def keep_norms_fp32(model):
+    """ Casts the inputs of every BatchNorm and LayerNorm layer of the model to fp32 (forward pre-hooks, in place). """
+    return [m.register_forward_pre_hook(to_fp32) for m in model.modules() if isinstance(m, NORM_LAYERS)]
@@ -0,0 +1,107 @@
+"""
+Opt-in graph compilation of PseTae with torch.compile
+
+The sub-modules of the model (pixel-set encoders, temporal attention encoders, decoder) are compiled separately and in
+place (nn.Module.compile, the state_dict keys are unchanged), so that their small ops (permutes, masked pooling,
+layernorms, small Linear layers) are fused. PseTae.forward, which dispatches on the fusion type and may run the sensor
+streams in threads, stays eager, and so does the ConvLSTM head, whose python loop over the time steps would be unrolled.
+Frames that fail to compile fall back to eager (torch._dynamo suppress_errors). The compiled kernels are cached on disk
+(TORCHINDUCTOR_CACHE_DIR), so that later runs skip most of the compilation.
+
+Usage:
+    model, report = compile_model(model, (x, x2, dates), train=True, cache_dir='compile_cache')
+    print(format_report(report))
+"""
+
+import os
+import time
+import torch
+
+from models.convlstm_fusion import convlstm
+
+# sub-modules kept eager
+EAGER_MODULES = (convlstm,)
+
+
+def step(model, example_inputs, train):
+    """ One training (forward+backward) or inference (no_grad forward) step. """
+    model.train(train)
+    if train:
+        model(*example_inputs).sum().backward()
+    else:
+        with torch.no_grad():
+            model(*example_inputs)
+
+
+def step_ms(model, example_inputs, train, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        step(model, example_inputs, train)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return 1000 * min(times)
+
+
+def compile_model(model, example_inputs, train=True, cache_dir=None, mode=None):
+    """
+    Compiles the sub-modules of the model in place and warms them up on one batch: training and inference steps if
+    train, inference steps only otherwise. The parameters, buffers, gradients and random state of the model are left
+    as they were before the warm-up.
+    Args:
+        model (nn.Module): PseTae model, on its device
+        example_inputs (tuple): one batch of inputs of the model (input_s1, input_s2, dates), on the same device
+        train (bool): if True the model will also be trained
+        cache_dir (str, optional): directory of the on-disk cache of compiled kernels (torch default if None)
+        mode (str, optional): torch.compile mode, e.g. 'reduce-overhead' or 'max-autotune-no-cudagraphs'
+    Returns:
+        the model and a report of the step times (ms) before and after compilation
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+    torch._dynamo.config.suppress_errors = True
+
+    training = model.training
+    buffers = {name: b.clone() for name, b in model.named_buffers()}
+    steps = ('train', 'eval') if train else ('eval',)
+    report = {'compiled': [], 'eager': [], 'mode': mode}
+
+    with torch.random.fork_rng():
+        for s in steps:
+            report['eager_{}_ms'.format(s)] = step_ms(model, example_inputs, s == 'train')
+
+        for name, module in model.named_children():
+            if isinstance(module, EAGER_MODULES):
+                report['eager'].append(name)
+            else:
+                module.compile(mode=mode)
+                report['compiled'].append(name)
+
+        start = time.perf_counter()
+        for s in steps:
+            step(model, example_inputs, s == 'train')
+        report['warmup_s'] = time.perf_counter() - start
+
+        for s in steps:
+            report['compiled_{}_ms'.format(s)] = step_ms(model, example_inputs, s == 'train')
+
+    with torch.no_grad():
+        for name, b in model.named_buffers():
+            b.copy_(buffers[name])
+    for p in model.parameters():
+        p.grad = None
+    model.train(training)
+    return model, report
+
+
+def format_report(report):
+    lines = ['compiled: {} | eager: {}'.format(', '.join(report['compiled']), ', '.join(report['eager']) or '-'),
+             'warm-up (compilation) {:.1f} s'.format(report['warmup_s'])]
+    for s in ('train', 'eval'):
+        if 'eager_{}_ms'.format(s) in report:
+            eager, compiled = report['eager_{}_ms'.format(s)], report['compiled_{}_ms'.format(s)]
+            lines.append('{:<5} step: eager {:.1f} ms | compiled {:.1f} ms | x{:.2f}'.format(s, eager, compiled,
+                                                                                         eager / compiled))
+    return '\n'.join(lines)
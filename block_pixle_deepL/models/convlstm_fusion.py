@@ -53,6 +53,9 @@ class ConvLSTMCell(nn.Module):
         combined = torch.cat([input_tensor, h_cur], dim=1)  # Concatenate along channel axis
         combined_conv = self.conv(combined)
       
+        return self.gates(combined_conv, c_cur)
+
+    def gates(self, combined_conv, c_cur):
         cc_i, cc_f, cc_o, cc_g = torch.split(combined_conv, self.hidden_dim, dim=1)
 
         i = torch.sigmoid(cc_i)
@@ -64,6 +67,23 @@ class ConvLSTMCell(nn.Module):
         h_next = o * torch.tanh(c_next)
         
         return h_next, c_next
+
+    def split_weight(self):
+        """ Input and recurrent halves of the gates convolution weight. """
+        return self.conv.weight[:, :self.input_dimc].contiguous(), self.conv.weight[:, self.input_dimc:].contiguous()
+
+    def input_conv(self, x, weight):
+        """
+        Input half of the gates convolution (with the bias) for all the timesteps at once.
+        x : Batch_size x Sequence_length x input_dimc x Length, returns Batch_size x Sequence_length x 4*hidden_dim x Length
+        """
+        b, t = x.shape[:2]
+        out = F.conv1d(x.reshape(b * t, *x.shape[2:]), weight, self.conv.bias, padding=self.padding)
+        return out.view(b, t, *out.shape[1:])
+
+    def recurrent_conv(self, h, weight):
+        """ Recurrent half of the gates convolution, on the hidden state only. """
+        return F.conv1d(h, weight, padding=self.padding)
     
 class convlstm(nn.Module):
     def __init__(self, input_dimc=1, hidden_dim=32, kernel_size=3,input_neuron = 128, output_dim=128,bias=False ):
@@ -95,6 +115,9 @@ class convlstm(nn.Module):
         self.fc3 = nn.Linear(int((input_neuron*hidden_dim)/4), int((input_neuron*hidden_dim)/8)) 
         self.fc4 = nn.Linear(int((input_neuron*hidden_dim)/8), int((input_neuron*hidden_dim)/16)) 
         self.fc5 = nn.Linear(int((input_neuron*hidden_dim)/16), output_dim) 
+        self._fc_cache = None
+        # input half of the gates precomputed for all the timesteps: None = only on GPU
+        self.precompute_input = None
 
     def forward(self, x, hidden=None, state=None):
 
@@ -108,24 +131,50 @@ class convlstm(nn.Module):
         b, c, t, h = x.shape
 
         if hidden is None:
-            hidden = torch.zeros((b, c, h))
+            hidden = torch.zeros((b, c, h), dtype=x.dtype, device=x.device)
         if state is None:
-            state = torch.zeros((b, c, h))
-        
-        if torch.cuda.is_available():
-            hidden = hidden.cuda()
-            state = state.cuda()
- 
-        for iter in range(t):
-            hidden, state = self.cell.forward(x[:, :, iter, :], (hidden, state))
+            state = torch.zeros((b, c, h), dtype=x.dtype, device=x.device)
+
+        precompute = x.is_cuda if self.precompute_input is None else self.precompute_input
+        if precompute:
+            # the input half of the gates does not depend on the recurrence: one conv for all the timesteps, only the
+            # recurrent half stays in the loop (unbind: a single backward node for all the timesteps)
+            w_x, w_h = self.cell.split_weight()
+            x_conv = self.cell.input_conv(x.permute(0, 2, 1, 3), w_x)
+            for x_t in x_conv.unbind(1):
+                hidden, state = self.cell.gates(x_t + self.cell.recurrent_conv(hidden, w_h), state)
+        else:
+            # on CPU one conv on [x_t, h] per step is as fast or faster than the split convs
+            for iter in range(t):
+                hidden, state = self.cell.forward(x[:, :, iter, :], (hidden, state))
 
         x = state
         x = self.flatten(x)  
-        x = self.fc1(x)
-        x = self.fc2(x)
-        x = self.fc3(x)
-        x = self.fc4(x)
-        x = self.fc5(x)
+        fc = [self.fc1, self.fc2, self.fc3, self.fc4, self.fc5]
+        if self.training or torch.is_grad_enabled() or any(type(l) is not nn.Linear for l in fc):
+            x = self.fc1(x)
+            x = self.fc2(x)
+            x = self.fc3(x)
+            x = self.fc4(x)
+            x = self.fc5(x)
+        else:
+            # fc1..fc5 have no nonlinearity in between: a single linear layer at inference
+            x = F.linear(x, *self.fc_collapsed(fc))
         
 
         return x
+
+    def fc_collapsed(self, layers):
+        """
+        Weight and bias of the composition of the linear layers (fc5(fc4(fc3(fc2(fc1(x)))))), cached until their
+        parameters are modified (training step, load_state_dict) or moved.
+        """
+        key = tuple((p._version, p.data_ptr()) for l in layers for p in (l.weight, l.bias))
+        if self._fc_cache is None or self._fc_cache[0] != key:
+            with torch.no_grad():
+                weight, bias = layers[0].weight, layers[0].bias
+                for l in layers[1:]:
+                    weight = l.weight @ weight
+                    bias = l.weight @ bias + l.bias
+            self._fc_cache = (key, weight, bias)
+        return self._fc_cache[1:]
@@ -0,0 +1,127 @@
+"""
+Inference-time graph optimizations for PseTae
+
+At inference the BatchNorm layers only apply a fixed affine transform, which can be folded into the adjacent Linear
+layer (Linear -> BatchNorm1d in linlayer, the PSE mlp2, the TAE mlp and the decoder, BatchNorm1d -> Linear in the TAE
+fc2), and Dropout is the identity. optimize_for_inference applies both to a copy of the model, then traces and freezes
+it with TorchScript.
+
+Usage:
+    model.load_state_dict(...)
+    model = optimize_for_inference(model, (x, x2, dates))  # one batch of the test loader
+    prediction = model(x, x2, dates)
+"""
+
+import copy
+import torch
+import torch.nn as nn
+
+
+def bn_scale_shift(bn):
+    """ Returns (scale, shift) such that bn(x) = x * scale + shift in eval mode. """
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.weight is not None:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.bias is not None:
+        shift = shift + bn.bias
+    return scale, shift
+
+
+def fold_linear_bn(lin, bn):
+    """ Folds a BatchNorm1d applied after a Linear layer into the Linear layer (in place). """
+    scale, shift = bn_scale_shift(bn)
+    bias = lin.bias if lin.bias is not None else torch.zeros_like(scale)
+    with torch.no_grad():
+        lin.weight.mul_(scale.unsqueeze(1))
+        lin.bias = nn.Parameter(bias * scale + shift)
+
+
+def fold_bn_linear(bn, lin):
+    """ Folds a BatchNorm1d applied before a Linear layer into the Linear layer (in place). """
+    scale, shift = bn_scale_shift(bn)
+    bias = lin.bias if lin.bias is not None else torch.zeros(lin.out_features, device=scale.device)
+    with torch.no_grad():
+        new_bias = bias + lin.weight @ shift
+        lin.weight.mul_(scale.unsqueeze(0))
+        lin.bias = nn.Parameter(new_bias)
+
+
+def fold_batchnorm(model):
+    """
+    Folds every BatchNorm1d adjacent to a Linear layer into it and replaces the BatchNorm1d by an Identity (in place).
+    Args:
+        model (nn.Module): model in eval mode
+    Returns:
+        the model and the number of folded BatchNorm layers
+    """
+    folded = 0
+    for module in model.modules():
+        if hasattr(module, 'lin') and isinstance(getattr(module, 'bn', None), nn.BatchNorm1d):  # linlayer
+            fold_linear_bn(module.lin, module.bn)
+            module.bn = nn.Identity()
+            folded += 1
+        elif isinstance(module, nn.Sequential):
+            i = 0
+            while i < len(module) - 1:
+                a, b = module[i], module[i + 1]
+                if isinstance(a, nn.Linear) and isinstance(b, nn.BatchNorm1d):
+                    fold_linear_bn(a, b)
+                    module[i + 1] = nn.Identity()
+                    folded += 1
+                elif isinstance(a, nn.BatchNorm1d) and isinstance(b, nn.Linear):
+                    fold_bn_linear(a, b)
+                    module[i] = nn.Identity()
+                    folded += 1
+                i += 1
+    return model, folded
+
+
+def strip_dropout(model):
+    """ Replaces every Dropout layer by an Identity (in place). """
+    for module in model.modules():
+        for name, child in module.named_children():
+            if isinstance(child, nn.Dropout):
+                setattr(module, name, nn.Identity())
+    return model
+
+
+def to_tuple(x):
+    if isinstance(x, torch.Tensor):
+        return x
+    return tuple(to_tuple(c) for c in x)
+
+
+class FrozenModel(nn.Module):
+    """
+    Frozen TorchScript module called with the same nested (list) inputs as the eager model. TorchScript only traces
+    tuples, so the inputs are converted before the call.
+    """
+
+    def __init__(self, module):
+        super(FrozenModel, self).__init__()
+        self.module = module
+
+    def forward(self, *input):
+        return self.module(*to_tuple(input))
+
+
+def optimize_for_inference(model, example_inputs=None, script=True):
+    """
+    Returns an inference-only copy of the model: BatchNorm folded, Dropout stripped and, if script, traced and frozen
+    with TorchScript.
+    Args:
+        model (nn.Module): trained model (e.g. PseTae), left unchanged
+        example_inputs (tuple): one batch of inputs of the model, as passed to its forward (required if script)
+        script (bool): if False the folded eager model is returned
+    """
+    model = copy.deepcopy(model).eval()
+    fold_batchnorm(model)
+    strip_dropout(model)
+    if not script:
+        return model
+
+    with torch.no_grad():
+        traced = torch.jit.trace(model, to_tuple(example_inputs), check_trace=False)
+    # torch.jit.optimize_for_inference is not applied: its MKLDNN conversions make these small layers slower on CPU
+    return FrozenModel(torch.jit.freeze(traced)).eval()
@@ -9,7 +9,7 @@ from datetime import datetime
 
 class PixelSetEncoder(nn.Module):
     def __init__(self, input_dim, mlp1=[10, 32, 64], pooling='mean_std', mlp2=[64, 128], with_extra=True,
-                 extra_size=4):
+                 extra_size=4, channels_last=False):
         """
         Pixel-set encoder.
         Args:
@@ -20,6 +20,8 @@ class PixelSetEncoder(nn.Module):
             mlp2 (list): Dimensions of the successive feature spaces of MLP2
             with_extra (bool): Whether additional pre-computed features are passed between the two MLPs
             extra_size (int, optional): Number of channels of the additional features, if any.
+            channels_last (bool): If True, MLP1 is applied to a flat (pixels, channels) tensor instead of permuting
+                every layer to channel last and back. The parameters and state_dict are the same in both layouts.
         """
 
         super(PixelSetEncoder, self).__init__()
@@ -28,6 +30,7 @@ class PixelSetEncoder(nn.Module):
         self.mlp1_dim = copy.deepcopy(mlp1)
         self.mlp2_dim = copy.deepcopy(mlp2)
         self.pooling = pooling
+        self.channels_last = channels_last
         
 
         self.with_extra = with_extra
@@ -106,8 +109,24 @@ class PixelSetEncoder(nn.Module):
         else:
             reshape_needed = False
 
-        out = self.mlp1(out)
-        out = torch.cat([pooling_methods[n](out, mask) for n in self.pooling.split('_')], dim=1)
+        if self.channels_last:
+            # pixels stay channel last through MLP1: one transpose in, none per layer
+            n, c, p = out.shape
+            out = out.transpose(1, 2).reshape(n * p, c)
+            for layer in self.mlp1:
+                out = layer.forward_flat(out)
+            out = out.view(n, p, -1)
+            if self.pooling == 'mean_std':
+                out = masked_mean_std(out, mask, channels_last=True)
+            else:
+                out = out.transpose(1, 2)
+                out = torch.cat([pooling_methods[n](out, mask) for n in self.pooling.split('_')], dim=1)
+        else:
+            out = self.mlp1(out)
+            if self.pooling == 'mean_std':
+                out = masked_mean_std(out, mask)
+            else:
+                out = torch.cat([pooling_methods[n](out, mask) for n in self.pooling.split('_')], dim=1)
 
         if self.with_extra:
             out = torch.cat([out, extra], dim=1)
@@ -137,6 +156,10 @@ class linlayer(nn.Module):
 
         return out
 
+    def forward_flat(self, input):
+        """ Same layer on a (Number of pixels) x Channels input, BatchNorm1d normalises over the same pixels. """
+        return F.relu(self.bn(self.lin(input)))
+
 def masked_mean(x, mask):
     out = x.permute((1, 0, 2))
     out = out * mask
@@ -160,6 +183,73 @@ def masked_std(x, mask):
     out = out.permute(1, 0)
     return out
 
+def masked_moments(x, mask, channels_last=False):
+    """
+    Masked mean and std of each channel, see MaskedMeanStd. This takes two reductions over x: the masked sum, then
+    the masked sum of squares of the centered x, which is the one x-sized temporary (squared in place). The sum of
+    squares of x itself would lose the std to cancellation on homogeneous parcels. Computed in fp32 with autocast
+    disabled, as bf16 reductions would lose it as well.
+    """
+    with torch.autocast(x.device.type, enabled=False):
+        x = x.float()
+        mask = mask.to(x.dtype)
+        s = mask.sum(dim=1, keepdim=True)  # N x 1
+        d = torch.where(s == 1, torch.full_like(s, 2), s) - 1
+
+        if channels_last:  # x : N x P x C
+            m = torch.bmm(mask.unsqueeze(1), x).squeeze(1) / s
+            c = x - m.unsqueeze(1)
+            v = torch.bmm(mask.unsqueeze(1), c.square_()).squeeze(1)
+        else:  # x : N x C x P
+            m = torch.bmm(x, mask.unsqueeze(-1)).squeeze(-1) / s
+            c = x - m.unsqueeze(-1)
+            v = torch.bmm(c.square_(), mask.unsqueeze(-1)).squeeze(-1)
+        sd = torch.sqrt(v / d + 10e-32)
+    return m, sd, mask, s, d
+
+
+class MaskedMeanStd(torch.autograd.Function):
+    """
+    Fused equivalent of torch.cat([masked_mean(x, mask), masked_std(x, mask)], dim=1), computed with two masked
+    reductions of x per channel (sum, then centered sum of squares) and a closed-form backward. The output is fp32.
+    """
+
+    @staticmethod
+    def forward(ctx, x, mask, channels_last=False):
+        m, sd, mask, s, d = masked_moments(x, mask, channels_last)
+        ctx.channels_last = channels_last
+        ctx.dtype = x.dtype
+        ctx.save_for_backward(x, mask, m, sd, s, d)
+        return torch.cat([m, sd], dim=1)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, mask, m, sd, s, d = ctx.saved_tensors
+        x = x.float()
+        grad_m, grad_sd = grad_out.float().chunk(2, dim=1)
+        # d(mean)/dx = mask / s and d(std)/dx = mask * (x - mean) / (d * std), d being the unbiased count s - 1
+        a = grad_sd / (d * sd)
+        b = grad_m / s
+        if ctx.channels_last:
+            grad_x = ((x - m.unsqueeze(1)) * a.unsqueeze(1) + b.unsqueeze(1)) * mask.unsqueeze(-1)
+        else:
+            grad_x = ((x - m.unsqueeze(-1)) * a.unsqueeze(-1) + b.unsqueeze(-1)) * mask.unsqueeze(1)
+        return grad_x.to(ctx.dtype), None, None
+
+
+def masked_mean_std(x, mask, channels_last=False):
+    """
+    Masked mean and standard deviation pooling of a Batch_size x Channels x Number_of_pixels tensor (or
+    Batch_size x Number_of_pixels x Channels if channels_last), returns a Batch_size x (2 * Channels) tensor (means
+    first).
+    """
+    if torch.is_grad_enabled() and x.requires_grad:
+        return MaskedMeanStd.apply(x, mask, channels_last)
+    # no backward needed (inference, tracing): plain ops
+    m, sd = masked_moments(x, mask, channels_last)[:2]
+    return torch.cat([m, sd], dim=1)
+
+
 def maximum(x, mask):
     return x.max(dim=-1)[0].squeeze()
 
@@ -0,0 +1,73 @@
+"""
+Int8 CPU inference for PseTae
+
+Both modes start from the BatchNorm-folded, Dropout-free copy of models/inference.py, so that every
+Linear -> BatchNorm1d pair is a single quantized Linear:
+    dynamic : weights of every nn.Linear (PSE, TAE, decoder) stored in int8, activations quantized on the fly
+    static  : activations are also quantized, with scales observed in a calibration pass over a few batches. Every
+              nn.Linear is wrapped between a QuantStub and a DeQuantStub, the rest of the model stays in float.
+
+Quantized models only run on CPU.
+"""
+
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+
+from models.inference import optimize_for_inference
+
+
+def quantize_dynamic(model):
+    """
+    Returns a copy of the model with dynamically quantized int8 Linear layers.
+    Args:
+        model (nn.Module): trained model (e.g. PseTae), left unchanged
+    """
+    model = optimize_for_inference(model, script=False).cpu()
+    return quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def wrap_linear(model, qconfig):
+    """ Wraps every nn.Linear of the model in a QuantWrapper with the given qconfig (in place). """
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Linear):
+                wrapper = quantization.QuantWrapper(child)
+                wrapper.qconfig = qconfig
+                setattr(module, name, wrapper)
+    return model
+
+
+def quantize_static(model, calibration_batches, backend='x86'):
+    """
+    Returns a copy of the model with statically quantized int8 Linear layers.
+    Args:
+        model (nn.Module): trained model (e.g. PseTae), left unchanged
+        calibration_batches (iterable): (input_s1, input_s2, dates) batches on CPU, used to observe the activation
+            ranges
+        backend (str): quantized engine, e.g. 'x86', 'fbgemm' or 'qnnpack'
+    """
+    torch.backends.quantized.engine = backend
+    model = optimize_for_inference(model, script=False).cpu()
+    wrap_linear(model, quantization.get_default_qconfig(backend))
+    quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for x, x2, dates in calibration_batches:
+            model(x, x2, dates)
+    return quantization.convert(model, inplace=True)
+
+
+def quantize(model, mode, calibration_batches=None):
+    """
+    Args:
+        model (nn.Module): trained model
+        mode (str): 'dynamic' or 'static'
+        calibration_batches (iterable, optional): batches for the static calibration pass
+    """
+    if mode == 'dynamic':
+        return quantize_dynamic(model)
+    elif mode == 'static':
+        if calibration_batches is None:
+            raise ValueError('Static quantization needs calibration batches')
+        return quantize_static(model, calibration_batches)
+    raise ValueError('Unknown quantization mode {}'.format(mode))
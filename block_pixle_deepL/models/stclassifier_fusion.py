@@ -5,6 +5,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import os, copy
+from collections import OrderedDict
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from models.pse_fusion import PixelSetEncoder 
@@ -14,19 +17,69 @@ from models.convlstm_fusion import convlstm
 from models.decoder import get_decoder
 
 
+# sub-modules used by each fusion type (the decoder is always used)
+FUSION_MODULES = {
+    'early': ('spatial_encoder_earlyFusion', 'temporal_encoder_earlyFusion'),
+    'convlstm': ('spatial_encoder_earlyFusion', 'convlstm_earlyFusion'),
+    'pse': ('spatial_encoder_s1', 'spatial_encoder_s2', 'temporal_encoder_pseFusion'),
+    'tsa': ('spatial_encoder_s1', 'spatial_encoder_s2', 'temporal_encoder_s1', 'temporal_encoder_s2'),
+    'softmax_norm': ('spatial_encoder_s1', 'spatial_encoder_s2', 'temporal_encoder_s1', 'temporal_encoder_s2'),
+    'softmax_avg': ('spatial_encoder_s1', 'spatial_encoder_s2', 'temporal_encoder_s1', 'temporal_encoder_s2'),
+}
+
+_sensor_pool = None
+
+
+def run_concurrently(f1, f2):
+    """
+    Returns (f1(), f2()), with f1 run in a worker thread while f2 runs in the calling thread. When the model is
+    traced, f1 is recorded with torch.jit.fork so that the TorchScript graph runs both on the inter-op thread pool.
+    """
+    if torch.jit.is_tracing():
+        future = torch.jit.fork(f1)
+        out2 = f2()
+        return torch.jit.wait(future), out2
+
+    global _sensor_pool
+    if _sensor_pool is None:
+        _sensor_pool = ThreadPoolExecutor(max_workers=1)
+    # grad mode and autocast state are thread-local: the worker runs f1 with those of the caller
+    grad = torch.is_grad_enabled()
+    autocast = [(device, torch.get_autocast_dtype(device)) for device in ('cpu', 'cuda')
+                if torch.is_autocast_enabled(device)]
+
+    def task():
+        with torch.set_grad_enabled(grad), ExitStack() as stack:
+            for device, dtype in autocast:
+                stack.enter_context(torch.autocast(device, dtype=dtype))
+            return f1()
+
+    future = _sensor_pool.submit(task)
+    out2 = f2()
+    return future.result(), out2
+
+
 class PseTae(nn.Module):
     """
     Pixel-Set encoder + Temporal Attention Encoder sequence classifier
+    By default the modules of every fusion type are built. With active_only=True only those used by fusion_type are
+    (smaller model, checkpoint and optimizer state); load_branch_state_dict loads a checkpoint of the full model into it.
+    With parallel_sensors=True the S1 and S2 streams of the pse, tsa and softmax_* fusions run concurrently (see
+    run_concurrently). In eval mode the two decoder calls of softmax_* are batched into one.
     """
 
     def __init__(self, input_dim_s1=2,input_dim_s2=10, mlp1=[10, 32, 64], pooling='mean_std', mlp2=[132, 128], with_extra=False,
                  extra_size=4,
                  n_head=4, d_k=32, d_model=None, mlp3=[512, 128, 128], dropout=0.2, T=1000, len_max_seq=55,
                  positions=None,
-                 mlp4=[128, 64, 32, 12], fusion_type=None,hidden_dim=32, kernel_size=3,input_neuron = 128, output_dim=128):
+                 mlp4=[128, 64, 32, 12], fusion_type=None,hidden_dim=32, kernel_size=3,input_neuron = 128, output_dim=128,
+                 channels_last=False, max_days=366, active_only=False, parallel_sensors=False):
         
         super(PseTae, self).__init__()
         
+        if active_only and fusion_type not in FUSION_MODULES:
+            raise ValueError('Unknown fusion type {}'.format(fusion_type))
+        used = FUSION_MODULES[fusion_type] if active_only else sum(FUSION_MODULES.values(), ())
 
         self.s1_max_len = len_max_seq
         self.s2_max_len = len_max_seq
@@ -37,14 +90,18 @@ class PseTae(nn.Module):
         
 
         # ----------------early fusion        
-        self.spatial_encoder_earlyFusion = PixelSetEncoder(input_dim=self.early_seq_mlp1[0], mlp1=self.early_seq_mlp1, pooling=pooling, mlp2=mlp2, with_extra=with_extra, extra_size=extra_size)    
+        if 'spatial_encoder_earlyFusion' in used:
+            self.spatial_encoder_earlyFusion = PixelSetEncoder(input_dim=self.early_seq_mlp1[0], mlp1=self.early_seq_mlp1, pooling=pooling, mlp2=mlp2, with_extra=with_extra, extra_size=extra_size,
+                                                               channels_last=channels_last)
         
 
-        self.temporal_encoder_earlyFusion = TemporalAttentionEncoder(in_channels=mlp2[-1], n_head=n_head, d_k=d_k, d_model=d_model,
-                                                         n_neurons=mlp3, dropout=dropout,
-                                                        T=T, len_max_seq=self.s2_max_len, positions=positions)
+        if 'temporal_encoder_earlyFusion' in used:
+            self.temporal_encoder_earlyFusion = TemporalAttentionEncoder(in_channels=mlp2[-1], n_head=n_head, d_k=d_k, d_model=d_model,
+                                                             n_neurons=mlp3, dropout=dropout,
+                                                            T=T, len_max_seq=self.s2_max_len, positions=positions, max_days=max_days)
 
-        self.convlstm_earlyFusion = convlstm(input_dimc=1, hidden_dim=32, kernel_size=3,input_neuron = 128, output_dim=128,bias=False)  
+        if 'convlstm_earlyFusion' in used:
+            self.convlstm_earlyFusion = convlstm(input_dimc=1, hidden_dim=32, kernel_size=3,input_neuron = 128, output_dim=128,bias=False)  
          
 
         # ----------------pse fusion
@@ -53,26 +110,31 @@ class PseTae(nn.Module):
         self.mlp3_pse = [1024, 512, 256]  
           
 
-        self.spatial_encoder_s2 =  PixelSetEncoder(input_dim_s2, mlp1=mlp1, pooling=pooling, mlp2=mlp2, with_extra=with_extra,
-                                               extra_size=extra_size)
+        if 'spatial_encoder_s2' in used:
+            self.spatial_encoder_s2 =  PixelSetEncoder(input_dim_s2, mlp1=mlp1, pooling=pooling, mlp2=mlp2, with_extra=with_extra,
+                                                   extra_size=extra_size, channels_last=channels_last)
         
-        self.spatial_encoder_s1 = PixelSetEncoder(input_dim_s1, mlp1=self.mlp1_s1, pooling=pooling, mlp2=mlp2, with_extra=with_extra,
-                                       extra_size=extra_size)
+        if 'spatial_encoder_s1' in used:
+            self.spatial_encoder_s1 = PixelSetEncoder(input_dim_s1, mlp1=self.mlp1_s1, pooling=pooling, mlp2=mlp2, with_extra=with_extra,
+                                           extra_size=extra_size, channels_last=channels_last)
     
 
-        self.temporal_encoder_pseFusion = TemporalAttentionEncoder(in_channels=mlp2[-1]*2, n_head=n_head, d_k=d_k, d_model=d_model,
-                                                         n_neurons=self.mlp3_pse, dropout=dropout,
-                                                        T=T, len_max_seq=self.s2_max_len, positions=positions) 
+        if 'temporal_encoder_pseFusion' in used:
+            self.temporal_encoder_pseFusion = TemporalAttentionEncoder(in_channels=mlp2[-1]*2, n_head=n_head, d_k=d_k, d_model=d_model,
+                                                             n_neurons=self.mlp3_pse, dropout=dropout,
+                                                            T=T, len_max_seq=self.s2_max_len, positions=positions, max_days=max_days) 
         
         
         # ------------------tsa fusion
-        self.temporal_encoder_s2 = TemporalAttentionEncoder(in_channels=mlp2[-1], n_head=n_head, d_k=d_k, d_model=d_model,
-                                                         n_neurons=mlp3, dropout=dropout,
-                                                         T=T, len_max_seq=self.s2_max_len, positions=positions) 
+        if 'temporal_encoder_s2' in used:
+            self.temporal_encoder_s2 = TemporalAttentionEncoder(in_channels=mlp2[-1], n_head=n_head, d_k=d_k, d_model=d_model,
+                                                             n_neurons=mlp3, dropout=dropout,
+                                                             T=T, len_max_seq=self.s2_max_len, positions=positions, max_days=max_days) 
         
-        self.temporal_encoder_s1 = TemporalAttentionEncoder(in_channels=mlp2[-1], n_head=n_head, d_k=d_k, d_model=d_model,
-                                                         n_neurons=mlp3, dropout=dropout,
-                                                         T=T, len_max_seq=self.s1_max_len, positions=positions)
+        if 'temporal_encoder_s1' in used:
+            self.temporal_encoder_s1 = TemporalAttentionEncoder(in_channels=mlp2[-1], n_head=n_head, d_k=d_k, d_model=d_model,
+                                                             n_neurons=mlp3, dropout=dropout,
+                                                             T=T, len_max_seq=self.s1_max_len, positions=positions, max_days=max_days)
                                                         
         
         self.decoder = get_decoder(mlp4)
@@ -82,6 +144,7 @@ class PseTae(nn.Module):
 
         self.name = fusion_type
         self.fusion_type = fusion_type
+        self.parallel_sensors = parallel_sensors
 
         
     def forward(self, input_s1, input_s2, dates): 
@@ -95,42 +158,27 @@ class PseTae(nn.Module):
         start = datetime.now()
         
         if self.fusion_type == 'pse':
-            out_s1 = self.spatial_encoder_s1(input_s1)
-            out_s2 = self.spatial_encoder_s2(input_s2)  
+            out_s1, out_s2 = self.sensor_streams(lambda: self.spatial_encoder_s1(input_s1),
+                                                 lambda: self.spatial_encoder_s2(input_s2))
             out = torch.cat((out_s1, out_s2), dim=2)
             out = self.temporal_encoder_pseFusion(out, dates[1]) #indexed for sentinel-2 dates 
             out = self.decoder(out) 
             
             
         elif self.fusion_type == 'tsa':
-            out_s1 = self.spatial_encoder_s1(input_s1)            
-            out_s1 = self.temporal_encoder_s1(out_s1, dates[0]) #indexed for sentinel-1 dates             
-            out_s2 = self.spatial_encoder_s2(input_s2)            
-            out_s2 = self.temporal_encoder_s2(out_s2, dates[1]) #indexed for sentinel-2 dates             
+            out_s1, out_s2 = self.encode_sensors(input_s1, input_s2, dates)
             out = torch.cat((out_s1, out_s2), dim=1)
             out = self.decoder(out)
                
             
             
         elif self.fusion_type == 'softmax_norm':
-            out_s1 = self.spatial_encoder_s1(input_s1)
-            out_s1 = self.temporal_encoder_s1(out_s1, dates[0]) 
-            out_s1 = self.decoder(out_s1)
-            
-            out_s2 = self.spatial_encoder_s2(input_s2)
-            out_s2 = self.temporal_encoder_s2(out_s2, dates[1]) 
-            out_s2 = self.decoder(out_s2)
+            out_s1, out_s2 = self.decode_sensors(*self.encode_sensors(input_s1, input_s2, dates))
             
             out = torch.divide(torch.multiply(out_s1, out_s2), torch.sum(torch.multiply(out_s1, out_s2)))
 
         elif self.fusion_type == 'softmax_avg':
-            out_s1 = self.spatial_encoder_s1(input_s1)
-            out_s1 = self.temporal_encoder_s1(out_s1, dates[0]) 
-            out_s1 = self.decoder(out_s1)
-            
-            out_s2 = self.spatial_encoder_s2(input_s2)
-            out_s2 = self.temporal_encoder_s2(out_s2, dates[1]) 
-            out_s2 = self.decoder(out_s2)
+            out_s1, out_s2 = self.decode_sensors(*self.encode_sensors(input_s1, input_s2, dates))
             
             out = torch.divide(torch.add(out_s1, out_s2), 2.0)
 
@@ -175,6 +223,38 @@ class PseTae(nn.Module):
         return out       
 
 
+    def sensor_streams(self, f1, f2):
+        """ Returns (f1(), f2()), run concurrently if parallel_sensors. """
+        if self.parallel_sensors and not torch.jit.is_scripting():
+            return run_concurrently(f1, f2)
+        return f1(), f2()
+
+    def encode_sensors(self, input_s1, input_s2, dates):
+        """ Spatial and temporal encoding of each sensor (tsa and softmax_* fusions). """
+        return self.sensor_streams(
+            lambda: self.temporal_encoder_s1(self.spatial_encoder_s1(input_s1), dates[0]),  # sentinel-1 dates
+            lambda: self.temporal_encoder_s2(self.spatial_encoder_s2(input_s2), dates[1]))  # sentinel-2 dates
+
+    def decode_sensors(self, out_s1, out_s2):
+        """
+        Applies the shared decoder to both sensor embeddings. In eval mode the BatchNorm layers use their running
+        statistics, so both are decoded as a single batch.
+        """
+        if self.training:
+            return self.decoder(out_s1), self.decoder(out_s2)
+        out = self.decoder(torch.cat((out_s1, out_s2), dim=0))
+        return out[:out_s1.shape[0]], out[out_s1.shape[0]:]
+
+    def load_branch_state_dict(self, state_dict, strict=True):
+        """
+        Loads a state_dict, ignoring the parameters of the sub-modules that were not built (e.g. a checkpoint of the
+        full model into an active_only model).
+        """
+        built = set(name for name, _ in self.named_children())
+        filtered = OrderedDict((k, v) for k, v in state_dict.items() if k.split('.')[0] in built)
+        filtered._metadata = getattr(state_dict, '_metadata', None)
+        return self.load_state_dict(filtered, strict=strict)
+
     def param_ratio(self):
         if self.fusion_type == 'pse':
             s = get_ntrainparams(self.spatial_encoder_s1)  + get_ntrainparams(self.spatial_encoder_s2)
@@ -18,11 +18,12 @@ import torch
 import torch.nn as nn
 import numpy as np
 import copy
+import functools
 from datetime import datetime
 
 class TemporalAttentionEncoder(nn.Module):
     def __init__(self, in_channels=128, n_head=4, d_k=32, d_model=None, n_neurons=[512, 128, 128], dropout=0.2,
-                 T=1000, len_max_seq=24, positions=None):
+                 T=1000, len_max_seq=24, positions=None, max_days=366):
         """
         Sequence-to-embedding encoder.
         Args:
@@ -34,7 +35,9 @@ class TemporalAttentionEncoder(nn.Module):
             dropout (float): dropout
             T (int): Period to use for the positional encoding
             len_max_seq (int, optional): Maximum sequence length, used to pre-compute the positional encoding table
-            positions (list, optional): List of temporal positions to use instead of position in the sequence
+            positions (list or str, optional): List of temporal positions to use instead of position in the sequence,
+                or 'dates' to encode the acquisition day offsets passed to forward (date_positions of PixelSetData)
+            max_days (int, optional): Largest day offset of the 'dates' positional encoding table
             d_model (int, optional): If specified, the input tensors will first processed by a fully connected layer
                 to project them into a feature space of dimension d_model
 
@@ -53,6 +56,11 @@ class TemporalAttentionEncoder(nn.Module):
         if positions is None:
             positions = len_max_seq + 1
 
+        elif isinstance(positions, str) and positions == 'dates':
+            # one row per day offset, indexed by the acquisition dates
+            positions = max_days + 1
+            self.name += '_datePos'
+
         else:
             self.name += '_bespokePos'
 
@@ -95,7 +103,10 @@ class TemporalAttentionEncoder(nn.Module):
         x = self.inlayernorm(x)
 
         # add pos enc to input using seq length
-        if self.positions is None:
+        if isinstance(self.positions, str) and self.positions == 'dates':
+            # dates: Sequence_length day offsets shared by the batch, or Batch_size x Sequence_length
+            src_pos = dates.to(device=x.device, dtype=torch.long)
+        elif self.positions is None:
             #src_pos = dates.long()
             src_pos = torch.arange(1, seq_len + 1, dtype=torch.long).expand(sz_b, seq_len).to(x.device)   #errrrrr
         else:
@@ -150,8 +161,7 @@ class MultiHeadAttention(nn.Module):
         k = self.fc1_k(k).view(sz_b, seq_len, n_head, d_k)
         k = k.permute(2, 0, 1, 3).contiguous().view(-1, seq_len, d_k)  # (n*b) x lk x dk
 
-        v = v.repeat(n_head, 1, 1)  # (n*b) x lv x d_in
-
+        # v (b x lv x d_in) is shared by the heads, it is not repeated n times
         output, attn = self.attention(q, k, v)
 
         output = output.view(n_head, sz_b, 1, d_in)
@@ -170,35 +180,49 @@ class ScaledDotProductAttention(nn.Module):
         self.softmax = nn.Softmax(dim=2)
 
     def forward(self, q, k, v):
+        """
+        Args:
+            q: (n*b) x dk queries
+            k: (n*b) x lk x dk keys
+            v: (n*b) x lv x dv values, or b x lv x dv values shared by the n heads
+        """
         attn = torch.matmul(q.unsqueeze(1), k.transpose(1, 2))
         attn = attn / self.temperature
 
         attn = self.softmax(attn)
         attn = self.dropout(attn)
-        output = torch.matmul(attn, v)
+        if v.shape[0] == attn.shape[0]:
+            output = torch.matmul(attn, v)
+        else:
+            # one bmm per head on the shared values. They are issued from the last head so that backward accumulates
+            # the gradient of v from the first head, in the order of the sum of v.repeat
+            attn_heads = attn.view(-1, v.shape[0], attn.shape[1], attn.shape[2]).unbind(0)
+            output = torch.cat([torch.bmm(a, v) for a in attn_heads[::-1]][::-1], dim=0)
 
         return output, attn
 
 
 def get_sinusoid_encoding_table(positions, d_hid, T=1000):
     ''' Sinusoid position encoding table
-    positions: int or list of integer, if int range(positions)'''
+    positions: int or list of integer, if int range(positions)
+    The table is built on CPU (nn.Embedding.from_pretrained keeps it as a frozen parameter, which follows model.to())
+    and cached, each call returns a copy.'''
 
-    if isinstance(positions, int):
-        positions = list(range(positions))
+    if not isinstance(positions, int):
+        positions = tuple(positions)
+    return sinusoid_table(positions, d_hid, T).clone()
 
-    def cal_angle(position, hid_idx):
-        return position / np.power(T, 2 * (hid_idx // 2) / d_hid)
 
-    def get_posi_angle_vec(position):
-        return [cal_angle(position, hid_j) for hid_j in range(d_hid)]
+@functools.lru_cache(maxsize=None)
+def sinusoid_table(positions, d_hid, T):
+    if isinstance(positions, int):
+        positions = range(positions)
 
-    sinusoid_table = np.array([get_posi_angle_vec(pos_i) for pos_i in positions])
+    position = np.asarray(positions, dtype=np.float64)[:, None]
+    hid_idx = np.arange(d_hid)
+    sinusoid_table = position / np.power(T, 2 * (hid_idx // 2) / d_hid)
 
     sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
     sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
 
-    if torch.cuda.is_available():
-        return torch.FloatTensor(sinusoid_table).cuda()
-    else:
-        return torch.FloatTensor(sinusoid_table)
+    return torch.FloatTensor(sinusoid_table)
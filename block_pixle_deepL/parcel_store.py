@@ -0,0 +1,196 @@
+"""
+Packed parcel store
+
+A split folder (e.g. ``dataset_folder/s1_data``) normally holds one ``DATA/<pid>.npy`` file per parcel. With tens of
+thousands of parcels the data loading is bound by open() calls rather than by compute. Packing turns the folder into
+a single contiguous pixel array plus an offset/length index keyed by parcel id, so that a parcel is read as a
+zero-copy slice of a memory map.
+
+Layout of ``<folder>/PACKED``:
+    pixels.npy : Total_pixels x Sequence_length x Channels array, parcels stored one after the other (sorted by pid)
+    index.npz  : pid, offset and length of every parcel in pixels.npy
+
+Usage (packs both s1_data and s2_data of a split):
+    python parcel_store.py /path/to/dataset_folder/s1_data --dtype float32
+"""
+
+import os
+import argparse
+import numpy as np
+import torch
+
+PACKED_DIR = 'PACKED'
+PIXELS_FILE = 'pixels.npy'
+INDEX_FILE = 'index.npz'
+
+
+def is_packed(folder):
+    """ Returns True if the split folder has already been packed. """
+    return os.path.isfile(os.path.join(folder, PACKED_DIR, INDEX_FILE)) and \
+        os.path.isfile(os.path.join(folder, PACKED_DIR, PIXELS_FILE))
+
+
+def scan_folder(folder, pid=None):
+    """
+    Reads the npy headers of the parcels of a split folder.
+    Args:
+        folder (str): path to the split folder containing the DATA directory
+        pid (list, optional): parcel ids to scan, defaults to all the parcels of the folder (sorted)
+    Returns:
+        pid, number of pixels of each parcel, (Sequence_length, Channels) and dtype of the parcels
+    """
+    data_folder = os.path.join(folder, 'DATA')
+    if pid is None:
+        pid = np.sort([int(f.split('.')[0]) for f in os.listdir(data_folder) if f.endswith('.npy')])
+    pid = np.asarray(pid, dtype=np.int64)
+    if len(pid) == 0:
+        raise ValueError('No parcel found in {}'.format(data_folder))
+
+    length = np.zeros(len(pid), dtype=np.int64)
+    seq_shape, file_dtype = None, None
+    for i, p in enumerate(pid):
+        x = np.load(os.path.join(data_folder, '{}.npy'.format(p)), mmap_mode='r')
+        if seq_shape is None:
+            seq_shape, file_dtype = x.shape[:2], x.dtype
+        elif x.shape[:2] != seq_shape:
+            raise ValueError('Parcel {} has shape {}, expected {} x N'.format(p, x.shape, seq_shape))
+        length[i] = x.shape[-1]
+    return pid, length, seq_shape, file_dtype
+
+
+def get_offsets(length):
+    offset = np.zeros(len(length), dtype=np.int64)
+    offset[1:] = np.cumsum(length)[:-1]
+    return offset
+
+
+def copy_parcels(folder, pid, offset, length, out):
+    """ Copies the parcel files pixel-first into out, so that each parcel is one contiguous block. """
+    data_folder = os.path.join(folder, 'DATA')
+    for i, p in enumerate(pid):
+        x = np.load(os.path.join(data_folder, '{}.npy'.format(p)))
+        out[offset[i]:offset[i] + length[i]] = x.transpose(2, 0, 1)
+
+
+def pack_folder(folder, dtype=None, overwrite=False):
+    """
+    Packs the DATA directory of a split folder into a single pixel array.
+    Args:
+        folder (str): path to the split folder containing the DATA directory
+        dtype (str, optional): dtype of the packed pixels (e.g. 'float32' or 'float16'), defaults to the dtype of the
+            parcel files
+        overwrite (bool): if False an existing packed store is left untouched
+    Returns:
+        path to the PACKED directory
+    """
+    out_folder = os.path.join(folder, PACKED_DIR)
+    if is_packed(folder) and not overwrite:
+        return out_folder
+    os.makedirs(out_folder, exist_ok=True)
+
+    pid, length, seq_shape, file_dtype = scan_folder(folder)
+    offset = get_offsets(length)
+
+    tmp_pixels = os.path.join(out_folder, PIXELS_FILE + '.tmp')
+    pixels = np.lib.format.open_memmap(tmp_pixels, mode='w+', dtype=np.dtype(dtype or file_dtype),
+                                       shape=(int(length.sum()), *seq_shape))
+    copy_parcels(folder, pid, offset, length, pixels)
+    pixels.flush()
+    del pixels
+
+    os.replace(tmp_pixels, os.path.join(out_folder, PIXELS_FILE))
+    np.savez(os.path.join(out_folder, INDEX_FILE), pid=pid, offset=offset, length=length)
+    return out_folder
+
+
+class PackedParcelStore(object):
+    """
+    Read access to a packed split folder. The pixel array is memory-mapped lazily (once per process), so the store
+    can be pickled to DataLoader workers without copying the data.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        with np.load(os.path.join(folder, PACKED_DIR, INDEX_FILE)) as index:
+            self.pid = index['pid']
+            self.offset = index['offset']
+            self.length = index['length']
+        self.position = dict((str(p), i) for i, p in enumerate(self.pid))
+        self._pixels = None
+
+    @property
+    def pixels(self):
+        if self._pixels is None:
+            self._pixels = np.load(os.path.join(self.folder, PACKED_DIR, PIXELS_FILE), mmap_mode='r')
+        return self._pixels
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pixels'] = None
+        return state
+
+    def __len__(self):
+        return len(self.pid)
+
+    def __contains__(self, pid):
+        return str(pid) in self.position
+
+    def get(self, pid):
+        """ Returns the parcel as a Sequence_length x Channels x Number_of_pixels view on the store (no copy). """
+        i = self.position[str(pid)]
+        o, n = self.offset[i], self.length[i]
+        return self.pixels[o:o + n].transpose(1, 2, 0)
+
+
+class ParcelArena(PackedParcelStore):
+    """
+    In-memory counterpart of PackedParcelStore: the raw parcels of a split folder are loaded once into a single
+    contiguous shared-memory tensor with an offset index. DataLoader workers all read the same arena (also when they
+    are spawned rather than forked), and the pixel sampling is still redrawn at every epoch by PixelSetData.
+    """
+
+    def __init__(self, folder, pid=None, dtype=None):
+        """
+        Args:
+            folder (str): path to the split folder, read from its packed store if there is one
+            pid (list, optional): parcel ids to load, defaults to all the parcels of the folder
+            dtype (str, optional): dtype of the arena, defaults to the dtype of the parcels
+        """
+        self.folder = folder
+        if is_packed(folder):
+            source = PackedParcelStore(folder)
+            self.pid = source.pid if pid is None else np.asarray(pid, dtype=np.int64)
+            self.length = np.array([source.length[source.position[str(p)]] for p in self.pid], dtype=np.int64)
+            seq_shape, file_dtype = source.pixels.shape[1:], source.pixels.dtype
+        else:
+            source = None
+            self.pid, self.length, seq_shape, file_dtype = scan_folder(folder, pid)
+        self.offset = get_offsets(self.length)
+        self.position = dict((str(p), i) for i, p in enumerate(self.pid))
+
+        torch_dtype = torch.from_numpy(np.zeros(0, dtype=np.dtype(dtype or file_dtype))).dtype
+        self.tensor = torch.empty((int(self.length.sum()), *seq_shape), dtype=torch_dtype).share_memory_()
+        self._pixels = self.tensor.numpy()
+        if source is None:
+            copy_parcels(folder, self.pid, self.offset, self.length, self._pixels)
+        else:
+            for i, p in enumerate(self.pid):
+                self._pixels[self.offset[i]:self.offset[i] + self.length[i]] = source.get(p).transpose(2, 0, 1)
+
+    @property
+    def pixels(self):
+        if self._pixels is None:
+            self._pixels = self.tensor.numpy()
+        return self._pixels
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the s1_data and s2_data parcels of a split folder.')
+    parser.add_argument('folder', type=str, help='Path to the s1_data folder of the split')
+    parser.add_argument('--dtype', default=None, type=str, help='dtype of the packed pixels (float32/float16)')
+    parser.add_argument('--overwrite', action='store_true', help='Re-pack even if a packed store exists')
+    args = parser.parse_args()
+
+    for f in (args.folder, args.folder.replace('s1_data', 's2_data')):
+        print('Packing {} . . .'.format(f))
+        print('Done ! -> {}'.format(pack_folder(f, dtype=args.dtype, overwrite=args.overwrite)))
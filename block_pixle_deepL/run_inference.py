@@ -7,6 +7,7 @@ from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
 import matplotlib.pyplot as plt
 import json
 import os
+import time
 import pickle as pkl
 import argparse
 import pprint
@@ -20,6 +21,9 @@ from torch import nn
 import torchnet as tnt
 from datetime import datetime
 from models.stclassifier_fusion import PseTae
+from models.compile import compile_model, format_report
+from models.inference import optimize_for_inference
+from models.quantization import quantize
 from dataset_fusion import PixelSetData, PixelSetData_preloaded
 from torchinfo import summary
 
@@ -55,8 +59,8 @@ def test_evaluation(model, criterion, loader, device, args, mode='test'):
         y_pred.extend(list(y_p))
 
 
-    y_true = [x if x in args['main_classes'] else args['others_classes'] for x in y_true]
-    y_pred = [x if x in args['main_classes'] else args['others_classes'] for x in y_pred]
+    y_true = map_classes(y_true, args)
+    y_pred = map_classes(y_pred, args)
     
     record.append(np.stack([ids, y_true, y_pred], axis=1))
     record = np.concatenate(record, axis=0)
@@ -72,6 +76,11 @@ def test_evaluation(model, criterion, loader, device, args, mode='test'):
 
 
 
+def map_classes(labels, args):
+    # classes outside the main classes are merged into the others class
+    return [x if x in args['main_classes'] else args['others_classes'] for x in labels]
+
+
 def get_pse(folder, args):
     mean_std1 = pkl.load(open(args['dataset_folder_meanstd1'] + '/S1-meanstd.pkl', 'rb'))
     mean_std2 = pkl.load(open(args['dataset_folder_meanstd2'] + '/S2-meanstd.pkl', 'rb'))
@@ -84,7 +93,8 @@ def get_pse(folder, args):
                           return_id=True,
                           fusion_type = args['fusion_type'], interpolate_method = args['interpolate_method'],
                           extra_feature='geomfeat' if args['geomfeat'] else None,  
-                          jitter=None)
+                          jitter=None,
+                          packed=args['packed'], batch_collate=args['batch_collate'])
     else:
         dt = PixelSetData(args[folder] , labels=args['label_class'], npixel=args['npixel'],
                           sub_classes = None,
@@ -94,19 +104,25 @@ def get_pse(folder, args):
                           return_id=True,
                           fusion_type = args['fusion_type'], interpolate_method = args['interpolate_method'],
                           extra_feature='geomfeat' if args['geomfeat'] else None,  
-                          jitter=None)
+                          jitter=None,
+                          packed=args['packed'], batch_collate=args['batch_collate'])
     
     
     return dt
 
 
+def get_collate(dataset, args):
+    # in batch_collate mode the items are raw parcels, collated by the dataset they come from
+    return dataset.collate_fn if args['batch_collate'] else None
+
 def get_loaders(args):
     loader_seq =[]
     test_dataset = get_pse('test_folder', args)
 
         
     test_loader = data.DataLoader(test_dataset, batch_size=args['batch_size'],
-                                    num_workers=args['num_workers'], shuffle = False, pin_memory =True)
+                                    num_workers=args['num_workers'], shuffle = False, pin_memory =True,
+                                    collate_fn=get_collate(test_dataset, args))
 
     loader_seq.append((test_loader))
     return loader_seq
@@ -153,6 +169,68 @@ def save_results(metrics, conf_mat, args):
     img.figure.savefig(os.path.join(args['res_dir'], 'conf_mat_picture_perclass.png'))
     img.get_figure().clf()
 
+def calibration_batches(loader, args):
+    # random sample of the test set for the static quantization calibration pass
+    dataset = loader.dataset
+    indices = np.random.choice(len(dataset), min(len(dataset), args['calibration_size']), replace=False)
+    sample_loader = data.DataLoader(data.Subset(dataset, indices), batch_size=args['batch_size'],
+                                    num_workers=args['num_workers'], shuffle=False, collate_fn=loader.collate_fn)
+    return [(x, x2, dates) for (x, x2, y, dates, ids) in sample_loader]
+
+
+def quantization_report(model, qmodel, loader, args):
+    """
+    Evaluates the fp32 and the quantized model on the test set (on CPU) and writes their accuracy, mIoU, F1-scores and
+    throughput, and the difference between the two, to quantization_report.json.
+    Both models are run on each test batch in turn, so that they see the same sampled pixels, and only their forward
+    passes are timed.
+    """
+    device = torch.device('cpu')
+    names = ['fp32', 'int8_{}'.format(args['quantize'])]
+    models = (model.to(device), qmodel)
+    acc_meters = [tnt.meter.ClassErrorMeter(accuracy=True) for _ in models]
+    y_preds = [[] for _ in models]
+    forward_s = [0. for _ in models]
+    y_true = []
+
+    for k, (x, x2, y, dates, ids) in enumerate(loader):
+        y_true.extend(list(map(int, y)))
+        x = recursive_todevice(x, device)
+        x2 = recursive_todevice(x2, device)
+        # the model run first alternates, so that neither always finds the batch in cache
+        for i in ((0, 1) if k % 2 == 0 else (1, 0)):
+            start = time.perf_counter()
+            with torch.no_grad():
+                prediction = models[i](x, x2, dates)
+            forward_s[i] += time.perf_counter() - start
+            acc_meters[i].add(prediction, y)
+            y_preds[i].extend(list(prediction.argmax(dim=1).numpy()))
+
+    y_true = map_classes(y_true, args)
+    report = {}
+    for i, name in enumerate(names):
+        y_pred = map_classes(y_preds[i], args)
+        conf_mat = confusion_matrix(y_true, y_pred, labels=list(range(args['num_classes'])))
+        per_class, perf = confusion_matrix_analysis(conf_mat)
+        report[name] = {'accuracy': acc_meters[i].value()[0],
+                        'IoU': mIou(y_true, y_pred, args['num_classes']),
+                        'MACRO_F1-score': perf['MACRO_F1-score'],
+                        'samples_per_sec': len(y_true) / forward_s[i],
+                        'F1-score': dict((c, d['F1-score']) for c, d in per_class.items())}
+
+    fp32, int8 = report[names[0]], report[names[1]]
+    report['delta'] = dict((k, int8[k] - fp32[k]) for k in ('accuracy', 'IoU', 'MACRO_F1-score'))
+    report['delta']['F1-score'] = dict((c, int8['F1-score'][c] - fp32['F1-score'][c]) for c in fp32['F1-score'])
+    report['speedup'] = int8['samples_per_sec'] / fp32['samples_per_sec']
+
+    print('{}: Acc {:+.2f},  IoU {:+.4f},  MACRO F1 {:+.4f},  throughput x{:.2f}'.format(
+        names[1], report['delta']['accuracy'], report['delta']['IoU'], report['delta']['MACRO_F1-score'],
+        report['speedup']))
+    with open(os.path.join(args['res_dir'], 'quantization_report.json'), 'w') as file:
+        file.write(json.dumps(report, indent=4))
+    return report
+
+
 def overall_performance(args):
     cm = np.zeros((args['num_classes'], args['num_classes']))
     cm += pkl.load(open(os.path.join(args['res_dir'], 'conf_mat.pkl'), 'rb'))
@@ -332,8 +410,10 @@ def main(args):
         model_args = dict(input_dim_s1=args['input_dim_s1'], input_dim_s2=args['input_dim_s2'], mlp1=args['mlp1'], pooling=args['pooling'],
                             mlp2=args['mlp2'], n_head=args['n_head'], d_k=args['d_k'], mlp3=args['mlp3'],
                             dropout=args['dropout'], T=args['T'], len_max_seq=args['lms'],
-                            positions=None, fusion_type = args['fusion_type'],
-                            mlp4=args['mlp4'],hidden_dim= args['hidden_dim'], kernel_size=args['kernel_size'], input_neuron = args['mlp2'][1], output_dim=args['mlp4'][0])
+                            positions='dates' if args['positions'] == 'dates' else None, fusion_type = args['fusion_type'],
+                            mlp4=args['mlp4'],hidden_dim= args['hidden_dim'], kernel_size=args['kernel_size'], input_neuron = args['mlp2'][1], output_dim=args['mlp4'][0],
+                            channels_last=args['channels_last'], max_days=args['max_days'],
+                            active_only=args['active_only'], parallel_sensors=args['parallel_sensors'])
 
         if args['geomfeat']:
             model_args.update(with_extra=True, extra_size=7) 
@@ -352,9 +432,27 @@ def main(args):
         criterion = FocalLoss(args['gamma'])
 
         print('Testing best epoch . . .')
-        model.load_state_dict(
+        model.load_branch_state_dict(
             torch.load(os.path.join(args['weight_dir'],  'model.pth.tar'))['state_dict'])
         model.eval()
+        if args['quantize'] is not None:
+            # int8 Linear layers, compared with the fp32 model on the test set. Quantized models run on CPU
+            batches = calibration_batches(test_loader, args) if args['quantize'] == 'static' else None
+            qmodel = quantize(model, args['quantize'], batches)
+            quantization_report(model, qmodel, test_loader, args)
+            model, device = qmodel, torch.device('cpu')
+        if args['optimize']:
+            # BatchNorm folded into the Linear layers, Dropout stripped, traced on one test batch and frozen
+            x, x2, _, dates, _ = next(iter(test_loader))
+            model = optimize_for_inference(model, (recursive_todevice(x, device), recursive_todevice(x2, device), dates))
+        elif args['compile']:
+            # compiled sub-modules, warmed up on one test batch (--optimize already freezes the model with TorchScript)
+            x, x2, _, dates, _ = next(iter(test_loader))
+            model, report = compile_model(model, (recursive_todevice(x, device), recursive_todevice(x2, device), dates),
+                                          train=False, cache_dir=args['compile_cache'], mode=args['compile_mode'])
+            print(format_report(report))
+            with open(os.path.join(args['res_dir'], 'compile_report.json'), 'w') as file:
+                file.write(json.dumps(report, indent=4))
 
         test_metrics, conf_mat = test_evaluation(model, criterion, test_loader, device=device, mode='test', args=args) 
 
@@ -402,6 +500,19 @@ def run_inference(test_path:str, mean_std_s1_path:str, mean_std_s2_path:str, wei
         parser.add_argument('--preload', dest='preload', action='store_true',
                             help='If specified, the whole dataset is loaded to RAM at initialization')
         parser.set_defaults(preload=False)
+        parser.add_argument('--packed', dest='packed', action='store_true',
+                            help='If specified, parcels are read from the packed store of each folder (see parcel_store.py)')
+        parser.set_defaults(packed=False)
+        parser.add_argument('--batch_collate', dest='batch_collate', action='store_true',
+                            help='If specified, pixel sampling, normalisation and jitter are applied to whole batches in the collate function')
+        parser.set_defaults(batch_collate=False)
+        parser.add_argument('--optimize', dest='optimize', action='store_true',
+                            help='If specified, inference runs on a BatchNorm-folded and frozen TorchScript copy of the model')
+        parser.set_defaults(optimize=False)
+        parser.add_argument('--quantize', default=None, type=str,
+                            help='int8 quantization of the Linear layers for CPU inference: dynamic or static')
+        parser.add_argument('--calibration_size', default=1024, type=int,
+                            help='Number of test samples used to calibrate static quantization')
         parser.add_argument('--label_class', default='label_51class', type=str, help='it can be label_19class or label_44class')
         parser.add_argument('--Delet_label_class', default=[], type=list, help='it can be label_19class or label_44class')
         parser.add_argument('--x_labels_list', default=["wi-bi-wr-br","o", "po", "of", "m","b", "others", "s", "g", "a", "p", "v", "fo", "ptwr", "f", "hn", "c", "to", "sb","nk", "z"] , type=list, help='The name of classes')
@@ -425,6 +536,22 @@ def run_inference(test_path:str, mean_std_s1_path:str, mean_std_s2_path:str, wei
 
         parser.add_argument('--mlp1', default='[17,32,64]', type=str, help='Number of neurons in the layers of MLP1 for S2 input')
         parser.add_argument('--pooling', default='mean_std', type=str, help='Pixel-embeddings pooling strategy')
+        parser.add_argument('--channels_last', dest='channels_last', action='store_true',
+                            help='If specified, the PSE MLP1 runs on channel-last pixel embeddings (same weights)')
+        parser.set_defaults(channels_last=False)
+        parser.add_argument('--active_only', dest='active_only', action='store_true',
+                            help='If specified, only the modules of the chosen fusion_type are built (full checkpoints still load)')
+        parser.set_defaults(active_only=False)
+        parser.add_argument('--parallel_sensors', dest='parallel_sensors', action='store_true',
+                            help='If specified, the S1 and S2 streams of the pse, tsa and softmax_* fusions run concurrently')
+        parser.set_defaults(parallel_sensors=False)
+        parser.add_argument('--compile', dest='compile', action='store_true',
+                            help='If specified, the sub-modules of the model are compiled with torch.compile (see models/compile.py)')
+        parser.set_defaults(compile=False)
+        parser.add_argument('--compile_mode', default=None, type=str,
+                            help='torch.compile mode, e.g. reduce-overhead or max-autotune-no-cudagraphs')
+        parser.add_argument('--compile_cache', default=None, type=str,
+                            help='Directory of the on-disk cache of compiled kernels (torch default if not specified)')
         parser.add_argument('--mlp2', default='[135,128]', type=str, help='Number of neurons in the layers of MLP2')
         parser.add_argument('--geomfeat', default=1, type=int,
                             help='If 1 the precomputed geometrical features (f) are used in the PSE.')
@@ -435,7 +562,9 @@ def run_inference(test_path:str, mean_std_s1_path:str, mean_std_s2_path:str, wei
         parser.add_argument('--mlp3', default='[512,128,128]', type=str, help='Number of neurons in the layers of MLP3')
         parser.add_argument('--T', default=1000, type=int, help='Maximum period for the positional encoding')
         parser.add_argument('--positions', default='bespoke', type=str,
-                            help='Positions to use for the positional encoding (bespoke / order)')
+                            help='Positions to use for the positional encoding (bespoke / order / dates: acquisition day offsets)')
+        parser.add_argument('--max_days', default=366, type=int,
+                            help='Largest acquisition day offset (only necessary if positions == dates)')
         parser.add_argument('--lms', default=55, type=int,
                             help='Maximum sequence length for positional encoding (only necessary if positions == order)')
         parser.add_argument('--dropout', default=0.2, type=float, help='Dropout probability')
@@ -6,7 +6,7 @@ import numpy as np
 import pandas as pd
 import torchnet as tnt
 # from sklearn.model_selection import KFold
-from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
+from sklearn.metrics import ConfusionMatrixDisplay
 import os
 import json
 import pickle as pkl
@@ -15,10 +15,15 @@ import pprint
 from datetime import datetime
 
 from models.stclassifier_fusion import PseTae
-from dataset_fusion import PixelSetData, PixelSetData_preloaded
+from models.compile import compile_model, format_report
+from dataset_fusion import PixelSetData, PixelSetData_preloaded, PixelSetStream
 from learning.focal_loss import FocalLoss
 from learning.weight_init import weight_init
-from learning.metrics import mIou, confusion_matrix_analysis
+from learning.metrics import confusion_matrix_analysis, ConfusionMatrixMeter
+from learning.precision import autocast, keep_norms_fp32
+from learning.distributed import (launch, is_distributed, get_rank, get_world_size, is_main, reduce_meters,
+                                  gather_lists, broadcast_buffers, broadcast_object)
+from torch.nn.parallel import DistributedDataParallel
 
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -27,120 +32,123 @@ from torchinfo import summary
 # %%
 def train_epoch(model, optimizer, criterion, data_loader, device, args):
     start = datetime.now()
-    acc_meter = tnt.meter.ClassErrorMeter(accuracy=True)
+    conf_meter = ConfusionMatrixMeter(args['num_classes'])
     loss_meter = tnt.meter.AverageValueMeter()
-    y_true = []
-    y_pred = []
     
 
     for i, (x, x2, y, dates, idss) in enumerate(data_loader): 
                 
-        y_true.extend(list(map(int, y)))
-
         x = recursive_todevice(x, device)
         x2 = recursive_todevice(x2, device) 
         y = y.to(device)
 
         optimizer.zero_grad()
-        out = model(x, x2, dates)
+        with autocast(args['precision'], device):
+            out = model(x, x2, dates)
+        out = out.float()  # loss and metrics in fp32
         loss = criterion(out, y.long())
         loss.backward()
         optimizer.step()
 
-        pred = out.detach()
-        y_p = pred.argmax(dim=1).cpu().numpy()
-        y_pred.extend(list(y_p))
-        acc_meter.add(pred, y)
+        conf_meter.add(out.detach(), y)
         loss_meter.add(loss.item())
 
         if (i + 1) % args['display_step'] == 0:
             print('Step [{}/{}], Loss: {:.4f}, Acc : {:.2f}'.format(i + 1, len(data_loader), loss_meter.value()[0],
-                                                                    acc_meter.value()[0]))
+                                                                    conf_meter.accuracy()))
 
+    # whole epoch over the ranks
+    reduce_meters(loss_meter, conf_meter)
     epoch_metrics = {'train_loss': loss_meter.value()[0],
-                     'train_accuracy': acc_meter.value()[0],
-                     'train_IoU': mIou(y_true, y_pred, n_classes=args['num_classes'])}
+                     'train_accuracy': conf_meter.accuracy(),
+                     'train_IoU': conf_meter.miou()}
     print('train epoch complete in ----------------------->', datetime.now()-start)
     return epoch_metrics
 
 
 def val_evaluation(model, criterion, loader, device, args, mode='val'):
-    y_true = []
-    y_pred = []
-
-    acc_meter = tnt.meter.ClassErrorMeter(accuracy=True)
+    conf_meter = ConfusionMatrixMeter(args['num_classes'])
     loss_meter = tnt.meter.AverageValueMeter()
 
     for (x, x2, y, dates, idss) in loader: 
 
-        y_true.extend(list(map(int, y)))
-
         x = recursive_todevice(x, device)
         x2 = recursive_todevice(x2, device) #add x2 to device
         y = y.to(device)
 
 
         with torch.no_grad():
-            prediction = model(x, x2, dates)  
+            with autocast(args['precision'], device):
+                prediction = model(x, x2, dates)
+            prediction = prediction.float()
             loss = criterion(prediction, y)
 
-        acc_meter.add(prediction, y)
+        conf_meter.add(prediction, y)
         loss_meter.add(loss.item())
 
-        y_p = prediction.argmax(dim=1).cpu().numpy()
-        y_pred.extend(list(y_p))
-
-    
-    metrics = {'{}_accuracy'.format(mode): acc_meter.value()[0],
+    reduce_meters(loss_meter, conf_meter)
+    metrics = {'{}_accuracy'.format(mode): conf_meter.accuracy(),
                '{}_loss'.format(mode): loss_meter.value()[0],
-               '{}_IoU'.format(mode): mIou(y_true, y_pred, args['num_classes'])}
+               '{}_IoU'.format(mode): conf_meter.miou()}
 
 
     return metrics
 
 
+def map_classes(labels, args):
+    # classes outside main_classes are merged into others_classes
+    main_classes = torch.as_tensor(args['main_classes'], device=labels.device)
+    return torch.where(torch.isin(labels, main_classes), labels, args['others_classes'])
+
+
 def test_evaluation(model, criterion, loader, device, args, mode='test'):
     y_true = []
     y_pred = []
     ids = []
     record = []    
 
-    acc_meter = tnt.meter.ClassErrorMeter(accuracy=True)
+    conf_meter = ConfusionMatrixMeter(args['num_classes'])  # accuracy on the original classes
+    mapped_meter = ConfusionMatrixMeter(args['num_classes'])  # IoU and confusion matrix on the mapped classes
     loss_meter = tnt.meter.AverageValueMeter()
 
     for (x, x2, y, dates, idss) in loader: 
 
         ids.extend(list(idss)) 
-        y_true.extend(list(map(int, y)))
               
         x = recursive_todevice(x, device)
         x2 = recursive_todevice(x2, device) #add x2 to device
         y = y.to(device)
               
         with torch.no_grad():
-            prediction = model(x, x2, dates)  
+            with autocast(args['precision'], device):
+                prediction = model(x, x2, dates)
+            prediction = prediction.float()
             loss = criterion(prediction, y)
 
-        acc_meter.add(prediction, y)
+        conf_meter.add(prediction, y)
         loss_meter.add(loss.item())
 
-        y_p = prediction.argmax(dim=1).cpu().numpy()
-        y_pred.extend(list(y_p))
+        y_t, y_p = map_classes(y.long(), args), map_classes(prediction.argmax(dim=1), args)
+        mapped_meter.add(y_p, y_t)
+        y_true.append(y_t.cpu())
+        y_pred.append(y_p.cpu())
 
 
-    y_true = [x if x in args['main_classes'] else args['others_classes'] for x in y_true]
-    y_pred = [x if x in args['main_classes'] else args['others_classes'] for x in y_pred]
-    
-    record.append(np.stack([ids, y_true, y_pred], axis=1))
+    reduce_meters(loss_meter, conf_meter, mapped_meter)
+    y_true, y_pred = torch.cat(y_true).numpy(), torch.cat(y_pred).numpy()
+    ids, y_true, y_pred = gather_lists(ids, y_true, y_pred)
+
+    record.append(np.stack([ids, np.asarray(y_true), np.asarray(y_pred)], axis=1))
     record = np.concatenate(record, axis=0)
-    np.save(os.path.join(args['res_dir'], 'Predictions_id_ytrue_y_pred.npy'), record)     
+    if is_main():
+        np.save(os.path.join(args['res_dir'], 'Predictions_id_ytrue_y_pred.npy'), record)     
             
-    metrics = {'{}_accuracy'.format(mode): acc_meter.value()[0],
+    metrics = {'{}_accuracy'.format(mode): conf_meter.accuracy(),
                '{}_loss'.format(mode): loss_meter.value()[0],
-               '{}_IoU'.format(mode): mIou(y_true, y_pred, args['num_classes'])}
+               '{}_IoU'.format(mode): mapped_meter.miou()}
 
 
-    return metrics, confusion_matrix(y_true, y_pred, labels=list(range(args['num_classes'])))
+    return metrics, mapped_meter.value()
 
 
 
@@ -156,7 +164,8 @@ def get_pse(folder, args):
                           return_id=True,
                           fusion_type = args['fusion_type'], interpolate_method = args['interpolate_method'],
                           extra_feature='geomfeat' if args['geomfeat'] else None,  
-                          jitter=None)
+                          jitter=None,
+                          packed=args['packed'], batch_collate=args['batch_collate'])
     else:
         dt = PixelSetData(args[folder], labels=args['label_class'], npixel=args['npixel'],
                           sub_classes = None,
@@ -166,31 +175,74 @@ def get_pse(folder, args):
                           return_id=True,
                           fusion_type = args['fusion_type'], interpolate_method = args['interpolate_method'],
                           extra_feature='geomfeat' if args['geomfeat'] else None,  
-                          jitter=None)
+                          jitter=None,
+                          packed=args['packed'], batch_collate=args['batch_collate'])
     
     
     return dt
 
+def get_stream(args):
+    # all the train folders are streamed by shards from their packed stores
+    mean_std1 = pkl.load(open(args['dataset_folder_meanstd1'] + '/S1-meanstd.pkl', 'rb'))
+    mean_std2 = pkl.load(open(args['dataset_folder_meanstd2'] + '/S2-meanstd.pkl', 'rb'))
+    folders = [args['dataset_folder']]
+    if args['dataset_folder2'] is not None:
+        folders.append(args['dataset_folder2'])
+    folders += [f for f in args['extra_folders'].split(',') if f]
+    return PixelSetStream(folders, labels=args['label_class'], npixel=args['npixel'],
+                          shard_size=args['shard_size'], shuffle=True, buffer_size=args['shuffle_buffer'],
+                          norm_s1=mean_std1,
+                          norm_s2=mean_std2,
+                          minimum_sampling=args['minimum_sampling'],
+                          return_id=True,
+                          fusion_type = args['fusion_type'], interpolate_method = args['interpolate_method'],
+                          extra_feature='geomfeat' if args['geomfeat'] else None,
+                          jitter=None,
+                          batch_collate=args['batch_collate'])
+
+def get_collate(dataset, args):
+    # in batch_collate mode the items are raw parcels, collated by the dataset they come from
+    return dataset.collate_fn if args['batch_collate'] else None
+
 def get_loaders(args):
     loader_seq =[]
-    train_dataset = get_pse('dataset_folder', args)
+    if args['stream']:
+        train_dataset = get_stream(args)
+    else:
+        train_dataset = get_pse('dataset_folder', args)
+    train_collate = get_collate(train_dataset, args)
     val_dataset = get_pse('val_folder', args)
     test_dataset = get_pse('test_folder', args)
     #print("type:",type(test_dataset.pid_shape_e()))
 
-    if args['dataset_folder2'] is not None:
+    if args['dataset_folder2'] is not None and not args['stream']:
         train_dataset2 = get_pse('dataset_folder2', args)
         train_dataset = data.ConcatDataset([train_dataset, train_dataset2])
 
-        
+    val_collate, test_collate = get_collate(val_dataset, args), get_collate(test_dataset, args)
+    train_sampler = None
+    if is_distributed():
+        if args['stream']:
+            raise ValueError('--stream is not supported with several processes')
+        # each rank trains on its own shuffled part of the train set (padded to the same number of batches) and
+        # evaluates a disjoint part of the val/test sets, the metrics are gathered over the ranks
+        train_sampler = data.distributed.DistributedSampler(train_dataset, shuffle=True, seed=args['rdm_seed'])
+        val_dataset = data.Subset(val_dataset, range(get_rank(), len(val_dataset), get_world_size()))
+        test_dataset = data.Subset(test_dataset, range(get_rank(), len(test_dataset), get_world_size()))
+
+    # the stream shuffles its shards itself
     train_loader = data.DataLoader(train_dataset, batch_size=args['batch_size'],
-                                        num_workers=args['num_workers'], shuffle = True, pin_memory =True) 
+                                        num_workers=args['num_workers'],
+                                        shuffle = not args['stream'] and train_sampler is None, pin_memory =True,
+                                        collate_fn=train_collate, sampler=train_sampler)
 
     validation_loader = data.DataLoader(val_dataset, batch_size=args['batch_size'],
-                                        num_workers=args['num_workers'], shuffle = False, pin_memory = True)
+                                        num_workers=args['num_workers'], shuffle = False, pin_memory = True,
+                                        collate_fn=val_collate)
 
     test_loader = data.DataLoader(test_dataset, batch_size=args['batch_size'],
-                                    num_workers=args['num_workers'], shuffle = False, pin_memory =True)
+                                    num_workers=args['num_workers'], shuffle = False, pin_memory =True,
+                                    collate_fn=test_collate)
 
     loader_seq.append((train_loader, validation_loader, test_loader))
     return loader_seq
@@ -546,17 +598,18 @@ it changed numerical_labels to string_labels
   
 
 def main(args):
-    np.random.seed(args['rdm_seed'])
-    torch.manual_seed(args['rdm_seed'])
-    prepare_output(args)
-
+    # different dropout/jitter draws in every rank (DistributedDataParallel starts all the ranks from the weights of rank 0)
+    np.random.seed(args['rdm_seed'] + get_rank())
+    torch.manual_seed(args['rdm_seed'] + get_rank())
     extra = 'geomfeat' if args['geomfeat'] else None
 
     device = torch.device(args['device'])
 
-    Data_distribution_train(args)
-    Data_distribution_val(args)
-    Data_distribution_test(args)
+    if is_main():
+        prepare_output(args)
+        Data_distribution_train(args)
+        Data_distribution_val(args)
+        Data_distribution_test(args)
 
     loaders = get_loaders(args)
     for _, (train_loader, val_loader, test_loader) in enumerate(loaders):
@@ -565,8 +618,10 @@ def main(args):
         model_args = dict(input_dim_s1=args['input_dim_s1'], input_dim_s2=args['input_dim_s2'], mlp1=args['mlp1'], pooling=args['pooling'],
                             mlp2=args['mlp2'], n_head=args['n_head'], d_k=args['d_k'], mlp3=args['mlp3'],
                             dropout=args['dropout'], T=args['T'], len_max_seq=args['lms'],
-                            positions=None, fusion_type = args['fusion_type'],
-                            mlp4=args['mlp4'],hidden_dim= args['hidden_dim'], kernel_size=args['kernel_size'], input_neuron = args['mlp2'][1], output_dim=args['mlp4'][0])
+                            positions='dates' if args['positions'] == 'dates' else None, fusion_type = args['fusion_type'],
+                            mlp4=args['mlp4'],hidden_dim= args['hidden_dim'], kernel_size=args['kernel_size'], input_neuron = args['mlp2'][1], output_dim=args['mlp4'][0],
+                            channels_last=args['channels_last'], max_days=args['max_days'],
+                            active_only=args['active_only'], parallel_sensors=args['parallel_sensors'])
 
         if args['geomfeat']:
             model_args.update(with_extra=True, extra_size=7) 
@@ -580,8 +635,26 @@ def main(args):
 
         model = model.to(device)
         model.apply(weight_init)
+        if args['precision'] == 'bf16':
+            # BatchNorm/LayerNorm statistics in fp32 under bfloat16 autocast
+            keep_norms_fp32(model)
         optimizer = torch.optim.NAdam(model.parameters())
         criterion = FocalLoss(args['gamma'])
+        if args['compile']:
+            # compiled sub-modules, warmed up on one training batch
+            x, x2, _, dates, _ = next(iter(train_loader))
+            with autocast(args['precision'], device):  # compiled for the precision of the training loop
+                model, report = compile_model(model, (recursive_todevice(x, device), recursive_todevice(x2, device), dates),
+                                              train=True, cache_dir=args['compile_cache'], mode=args['compile_mode'])
+            print(format_report(report))
+            if is_main():
+                with open(os.path.join(args['res_dir'], 'compile_report.json'), 'w') as file:
+                    file.write(json.dumps(report, indent=4))
+
+        # the gradients are averaged over the ranks; model (the module itself) is used for evaluation and checkpoints
+        train_model = model
+        if is_distributed():
+            train_model = DistributedDataParallel(model, find_unused_parameters=not args['active_only'])
 
         trainlog = {}
 
@@ -590,10 +663,13 @@ def main(args):
         for epoch in range(1, args['epochs'] + 1):
             print('EPOCH {}/{}'.format(epoch, args['epochs']))
 
+            if train_loader.sampler is not None and hasattr(train_loader.sampler, 'set_epoch'):
+                train_loader.sampler.set_epoch(epoch)
             model.train()
-            train_metrics = train_epoch(model, optimizer, criterion, train_loader, device=device, args=args)
+            train_metrics = train_epoch(train_model, optimizer, criterion, train_loader, device=device, args=args)
 
             print('Validation . . . ')
+            broadcast_buffers(model)  # every rank evaluates the model of rank 0, the one saved as checkpoint
             model.eval()
             val_metrics = val_evaluation(model, criterion, val_loader, device=device, args=args, mode='val')
 
@@ -601,17 +677,22 @@ def main(args):
                                                                  val_metrics['val_IoU']))
 
             trainlog[epoch] = {**train_metrics, **val_metrics}
-            checkpoint(trainlog, args)
+            if is_main():
+                checkpoint(trainlog, args)
 
+            # the val metrics are gathered over the ranks, all of them take the same decision
             if val_metrics['val_IoU'] >= best_mIoU:
                 best_mIoU = val_metrics['val_IoU']
-                torch.save({'epoch': epoch, 'state_dict': model.state_dict(),
-                            'optimizer': optimizer.state_dict()},
-                           os.path.join(args['res_dir'], 'model.pth.tar'))
+                if is_main():
+                    torch.save({'epoch': epoch, 'state_dict': model.state_dict(),
+                                'optimizer': optimizer.state_dict()},
+                               os.path.join(args['res_dir'], 'model.pth.tar'))
 
         print('Testing best epoch . . .')
-        model.load_state_dict(
-            torch.load(os.path.join(args['res_dir'],  'model.pth.tar'))['state_dict'])
+        # read by rank 0, which wrote it, and sent to the other ranks (res_dir need not be shared between hosts)
+        state_dict = torch.load(os.path.join(args['res_dir'], 'model.pth.tar'),
+                                map_location='cpu')['state_dict'] if is_main() else None
+        model.load_state_dict(broadcast_object(state_dict))
         model.eval()
 
         test_metrics, conf_mat = test_evaluation(model, criterion, test_loader, device=device, mode='test', args=args) 
@@ -619,11 +700,13 @@ def main(args):
         print('Loss {:.4f},  Acc {:.2f},  IoU {:.4f}'.format(test_metrics['test_loss'], test_metrics['test_accuracy'],
                                                              test_metrics['test_IoU']))
                                                              
-        save_results(test_metrics, conf_mat, args) 
+        if is_main():
+            save_results(test_metrics, conf_mat, args) 
 
-    overall_performance(args)
-    plot_metrics(args)
-    shape_file(args)
+    if is_main():
+        overall_performance(args)
+        plot_metrics(args)
+        shape_file(args)
 
 
 
@@ -673,6 +756,19 @@ def run_main(train_path:str, validation_path:str, test_path:str, mean_std_s1_pat
         parser.add_argument('--preload', dest='preload', action='store_true',
                             help='If specified, the whole dataset is loaded to RAM at initialization')
         parser.set_defaults(preload=False)
+        parser.add_argument('--packed', dest='packed', action='store_true',
+                            help='If specified, parcels are read from the packed store of each folder (see parcel_store.py)')
+        parser.set_defaults(packed=False)
+        parser.add_argument('--batch_collate', dest='batch_collate', action='store_true',
+                            help='If specified, pixel sampling, normalisation and jitter are applied to whole batches in the collate function')
+        parser.set_defaults(batch_collate=False)
+        parser.add_argument('--stream', dest='stream', action='store_true',
+                            help='If specified, the packed train folders (dataset_folder, dataset_folder2 and extra_folders) are streamed by shards instead of being indexed in RAM')
+        parser.set_defaults(stream=False)
+        parser.add_argument('--extra_folders', default='', type=str,
+                            help='Comma-separated paths to additional train folders, streamed with --stream')
+        parser.add_argument('--shard_size', default=1024, type=int, help='Number of consecutive parcels in a stream shard')
+        parser.add_argument('--shuffle_buffer', default=4096, type=int, help='Number of items in the stream shuffle buffer')
         parser.add_argument('--label_class', default='label_51class', type=str, help='it can be label_19class or label_44class')
         parser.add_argument('--Delet_label_class', default=[], type=list, help='it can be label_19class or label_44class')
         parser.add_argument('--x_labels_list', default=["wi-bi-wr-br","o", "po", "of", "m","b", "others", "s", "g", "a", "p", "v", "fo", "ptwr", "f", "hn", "c", "to", "sb","nk", "z"] , type=list, help='The name of classes')
@@ -698,6 +794,26 @@ def run_main(train_path:str, validation_path:str, test_path:str, mean_std_s1_pat
 
         parser.add_argument('--mlp1', default='[17,32,64]', type=str, help='Number of neurons in the layers of MLP1 for S2 input')
         parser.add_argument('--pooling', default='mean_std', type=str, help='Pixel-embeddings pooling strategy')
+        parser.add_argument('--channels_last', dest='channels_last', action='store_true',
+                            help='If specified, the PSE MLP1 runs on channel-last pixel embeddings (same weights)')
+        parser.set_defaults(channels_last=False)
+        parser.add_argument('--active_only', dest='active_only', action='store_true',
+                            help='If specified, only the modules of the chosen fusion_type are built (full checkpoints still load)')
+        parser.set_defaults(active_only=False)
+        parser.add_argument('--parallel_sensors', dest='parallel_sensors', action='store_true',
+                            help='If specified, the S1 and S2 streams of the pse, tsa and softmax_* fusions run concurrently')
+        parser.set_defaults(parallel_sensors=False)
+        parser.add_argument('--nproc', default=1, type=int,
+                            help='Number of DistributedDataParallel (gloo) training processes on this host (see learning/distributed.py)')
+        parser.add_argument('--precision', default='fp32', type=str,
+                            help='fp32, or bf16 for bfloat16 autocast in training and evaluation (see learning/precision.py)')
+        parser.add_argument('--compile', dest='compile', action='store_true',
+                            help='If specified, the sub-modules of the model are compiled with torch.compile (see models/compile.py)')
+        parser.set_defaults(compile=False)
+        parser.add_argument('--compile_mode', default=None, type=str,
+                            help='torch.compile mode, e.g. reduce-overhead or max-autotune-no-cudagraphs')
+        parser.add_argument('--compile_cache', default=None, type=str,
+                            help='Directory of the on-disk cache of compiled kernels (torch default if not specified)')
         parser.add_argument('--mlp2', default='[135,128]', type=str, help='Number of neurons in the layers of MLP2')
         parser.add_argument('--geomfeat', default=1, type=int,
                             help='If 1 the precomputed geometrical features (f) are used in the PSE.')
@@ -708,7 +824,9 @@ def run_main(train_path:str, validation_path:str, test_path:str, mean_std_s1_pat
         parser.add_argument('--mlp3', default='[512,128,128]', type=str, help='Number of neurons in the layers of MLP3')
         parser.add_argument('--T', default=1000, type=int, help='Maximum period for the positional encoding')
         parser.add_argument('--positions', default='bespoke', type=str,
-                            help='Positions to use for the positional encoding (bespoke / order)')
+                            help='Positions to use for the positional encoding (bespoke / order / dates: acquisition day offsets)')
+        parser.add_argument('--max_days', default=366, type=int,
+                            help='Largest acquisition day offset (only necessary if positions == dates)')
         parser.add_argument('--lms', default=55, type=int,
                             help='Maximum sequence length for positional encoding (only necessary if positions == order)')
         parser.add_argument('--dropout', default=0.2, type=float, help='Dropout probability')
@@ -731,7 +849,7 @@ def run_main(train_path:str, validation_path:str, test_path:str, mean_std_s1_pat
                     args[k] = list(map(int, v.split(',')))
 
         pprint.pprint(args)
-        main(args)
+        launch(main, args)
 
 
         #add processing time
@@ -15,6 +15,7 @@ import pprint
 from datetime import datetime
 
 from models.stclassifier_fusion import PseTae
+from models.compile import compile_model, format_report
 from dataset_fusion import PixelSetData, PixelSetData_preloaded
 from learning.focal_loss import FocalLoss
 from learning.weight_init import weight_init
@@ -156,7 +157,8 @@ def get_pse(folder, args):
                           return_id=True,
                           fusion_type = args['fusion_type'], interpolate_method = args['interpolate_method'],
                           extra_feature='geomfeat' if args['geomfeat'] else None,  
-                          jitter=None)
+                          jitter=None,
+                          packed=args['packed'], batch_collate=args['batch_collate'])
     else:
         dt = PixelSetData(args[folder], labels=args['label_class'], npixel=args['npixel'],
                           sub_classes = None,
@@ -166,14 +168,20 @@ def get_pse(folder, args):
                           return_id=True,
                           fusion_type = args['fusion_type'], interpolate_method = args['interpolate_method'],
                           extra_feature='geomfeat' if args['geomfeat'] else None,  
-                          jitter=None)
+                          jitter=None,
+                          packed=args['packed'], batch_collate=args['batch_collate'])
     
     
     return dt
 
+def get_collate(dataset, args):
+    # in batch_collate mode the items are raw parcels, collated by the dataset they come from
+    return dataset.collate_fn if args['batch_collate'] else None
+
 def get_loaders(args):
     loader_seq =[]
     train_dataset = get_pse('dataset_folder', args)
+    train_collate = get_collate(train_dataset, args)
     val_dataset = get_pse('val_folder', args)
     test_dataset = get_pse('test_folder', args)
     #print("type:",type(test_dataset.pid_shape_e()))
@@ -184,13 +192,16 @@ def get_loaders(args):
 
         
     train_loader = data.DataLoader(train_dataset, batch_size=args['batch_size'],
-                                        num_workers=args['num_workers'], shuffle = True, pin_memory =True) 
+                                        num_workers=args['num_workers'], shuffle = True, pin_memory =True,
+                                        collate_fn=train_collate)
 
     validation_loader = data.DataLoader(val_dataset, batch_size=args['batch_size'],
-                                        num_workers=args['num_workers'], shuffle = False, pin_memory = True)
+                                        num_workers=args['num_workers'], shuffle = False, pin_memory = True,
+                                        collate_fn=get_collate(val_dataset, args))
 
     test_loader = data.DataLoader(test_dataset, batch_size=args['batch_size'],
-                                    num_workers=args['num_workers'], shuffle = False, pin_memory =True)
+                                    num_workers=args['num_workers'], shuffle = False, pin_memory =True,
+                                    collate_fn=get_collate(test_dataset, args))
 
     loader_seq.append((train_loader, validation_loader, test_loader))
     return loader_seq
@@ -565,8 +576,10 @@ def main(args):
         model_args = dict(input_dim_s1=args['input_dim_s1'], input_dim_s2=args['input_dim_s2'], mlp1=args['mlp1'], pooling=args['pooling'],
                             mlp2=args['mlp2'], n_head=args['n_head'], d_k=args['d_k'], mlp3=args['mlp3'],
                             dropout=args['dropout'], T=args['T'], len_max_seq=args['lms'],
-                            positions=None, fusion_type = args['fusion_type'],
-                            mlp4=args['mlp4'],hidden_dim= args['hidden_dim'], kernel_size=args['kernel_size'], input_neuron = args['mlp2'][1], output_dim=args['mlp4'][0])
+                            positions='dates' if args['positions'] == 'dates' else None, fusion_type = args['fusion_type'],
+                            mlp4=args['mlp4'],hidden_dim= args['hidden_dim'], kernel_size=args['kernel_size'], input_neuron = args['mlp2'][1], output_dim=args['mlp4'][0],
+                            channels_last=args['channels_last'], max_days=args['max_days'],
+                            active_only=args['active_only'], parallel_sensors=args['parallel_sensors'])
 
         if args['geomfeat']:
             model_args.update(with_extra=True, extra_size=7) 
@@ -575,7 +588,7 @@ def main(args):
 
         model = PseTae(**model_args)
                 ###############Freeze Layers (TL)###############
-        model.load_state_dict(
+        model.load_branch_state_dict(
             torch.load(os.path.join(args['res_dir_WE'], 'model.pth.tar'))['state_dict'])  
         model_weights = model.state_dict()
         print("model_weights:", model_weights)
@@ -584,11 +597,14 @@ def main(args):
         sum_model = summary(model)
         print("Summary of the model_beforfreez: ",sum_model )
 
-        for param in model.spatial_encoder_s1.parameters(): 
-         param.requires_grad = False
+        # the single-sensor encoders are not built for early/convlstm fusion with --active_only
+        if hasattr(model, 'spatial_encoder_s1'):
+            for param in model.spatial_encoder_s1.parameters(): 
+             param.requires_grad = False
 
-        for param in model.spatial_encoder_s2.parameters(): 
-         param.requires_grad = False
+        if hasattr(model, 'spatial_encoder_s2'):
+            for param in model.spatial_encoder_s2.parameters(): 
+             param.requires_grad = False
 
         #for param in model.temporal_encoder_pseFusion.parameters(): 
         # param.requires_grad = False
@@ -605,6 +621,14 @@ def main(args):
         #model.apply(weight_init)
         optimizer = torch.optim.NAdam(model.parameters())
         criterion = FocalLoss(args['gamma'])
+        if args['compile']:
+            # compiled sub-modules, warmed up on one training batch
+            x, x2, _, dates, _ = next(iter(train_loader))
+            model, report = compile_model(model, (recursive_todevice(x, device), recursive_todevice(x2, device), dates),
+                                          train=True, cache_dir=args['compile_cache'], mode=args['compile_mode'])
+            print(format_report(report))
+            with open(os.path.join(args['res_dir'], 'compile_report.json'), 'w') as file:
+                file.write(json.dumps(report, indent=4))
 
         trainlog = {}
 
@@ -697,6 +721,12 @@ def run_transferlearning(train_path:str, validation_path:str, test_path:str, mea
         parser.add_argument('--preload', dest='preload', action='store_true',
                             help='If specified, the whole dataset is loaded to RAM at initialization')
         parser.set_defaults(preload=False)
+        parser.add_argument('--packed', dest='packed', action='store_true',
+                            help='If specified, parcels are read from the packed store of each folder (see parcel_store.py)')
+        parser.set_defaults(packed=False)
+        parser.add_argument('--batch_collate', dest='batch_collate', action='store_true',
+                            help='If specified, pixel sampling, normalisation and jitter are applied to whole batches in the collate function')
+        parser.set_defaults(batch_collate=False)
         parser.add_argument('--label_class', default='label_51class', type=str, help='it can be label_19class or label_44class')
         parser.add_argument('--Delet_label_class', default=[], type=list, help='it can be label_19class or label_44class')
         parser.add_argument('--x_labels_list', default=["wi-bi-wr-br","o", "po", "of", "m","b", "others", "s", "g", "a", "p", "v", "fo", "ptwr", "f", "hn", "c", "to", "sb","nk", "z"] , type=list, help='The name of classes')
@@ -722,6 +752,22 @@ def run_transferlearning(train_path:str, validation_path:str, test_path:str, mea
 
         parser.add_argument('--mlp1', default='[17,32,64]', type=str, help='Number of neurons in the layers of MLP1 for S2 input')
         parser.add_argument('--pooling', default='mean_std', type=str, help='Pixel-embeddings pooling strategy')
+        parser.add_argument('--channels_last', dest='channels_last', action='store_true',
+                            help='If specified, the PSE MLP1 runs on channel-last pixel embeddings (same weights)')
+        parser.set_defaults(channels_last=False)
+        parser.add_argument('--active_only', dest='active_only', action='store_true',
+                            help='If specified, only the modules of the chosen fusion_type are built (full checkpoints still load)')
+        parser.set_defaults(active_only=False)
+        parser.add_argument('--parallel_sensors', dest='parallel_sensors', action='store_true',
+                            help='If specified, the S1 and S2 streams of the pse, tsa and softmax_* fusions run concurrently')
+        parser.set_defaults(parallel_sensors=False)
+        parser.add_argument('--compile', dest='compile', action='store_true',
+                            help='If specified, the sub-modules of the model are compiled with torch.compile (see models/compile.py)')
+        parser.set_defaults(compile=False)
+        parser.add_argument('--compile_mode', default=None, type=str,
+                            help='torch.compile mode, e.g. reduce-overhead or max-autotune-no-cudagraphs')
+        parser.add_argument('--compile_cache', default=None, type=str,
+                            help='Directory of the on-disk cache of compiled kernels (torch default if not specified)')
         parser.add_argument('--mlp2', default='[135,128]', type=str, help='Number of neurons in the layers of MLP2')
         parser.add_argument('--geomfeat', default=1, type=int,
                             help='If 1 the precomputed geometrical features (f) are used in the PSE.')
@@ -732,7 +778,9 @@ def run_transferlearning(train_path:str, validation_path:str, test_path:str, mea
         parser.add_argument('--mlp3', default='[512,128,128]', type=str, help='Number of neurons in the layers of MLP3')
         parser.add_argument('--T', default=1000, type=int, help='Maximum period for the positional encoding')
         parser.add_argument('--positions', default='bespoke', type=str,
-                            help='Positions to use for the positional encoding (bespoke / order)')
+                            help='Positions to use for the positional encoding (bespoke / order / dates: acquisition day offsets)')
+        parser.add_argument('--max_days', default=366, type=int,
+                            help='Largest acquisition day offset (only necessary if positions == dates)')
         parser.add_argument('--lms', default=55, type=int,
                             help='Maximum sequence length for positional encoding (only necessary if positions == order)')
         parser.add_argument('--dropout', default=0.2, type=float, help='Dropout probability')